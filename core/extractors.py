@@ -1,21 +1,112 @@
+import copy
 import re
-import json
 from datetime import datetime, timedelta
+from functools import cached_property
 
+from core import fastjson
+
+
+class Patterns:
+    csrf_token = re.compile('<meta content="(.+?)" name="csrf-token"')
+    h = re.compile(r"&h=(\w+)")
+    build_queue = re.compile('(?s)<table id="build_queue"(.+?)</table>')
+    build_queue_item = re.compile(
+        r'<tr class=".+? buildorder_(.+?)"[ >].+?data-available-to="(.+?)"',
+        re.M | re.S,
+    )
+    village_data = re.compile(r"var village = (.+);")
+    game_state = re.compile(r"TribalWars\.updateGameData\((.+?)\);")
+    building_data = re.compile(r"(?s)BuildingMain.buildings = (\{.+?\});")
+    quests = re.compile(r"Quests.setQuestData\((\{.+?\})\);")
+    quest_rewards = re.compile(r"RewardSystem\.setRewards\((\[\{.+?\}\]),")
+    map_data = re.compile(r"(?s)TWMap.sectorPrefech = (\[(.+?)\]);")
+    smith_data = re.compile(r"(?s)BuildingSmith.techs = (\{.+?\});")
+    premium_data = re.compile(r"(?s)PremiumExchange.receiveData\((.+?)\);")
+    recruit_data = re.compile(r"(?s)unit_managers.units = (\{.+?\});")
+    quote_keys = re.compile(r"([\{\s,])(\w+)(:)")
+    units_home = re.compile('(?s)<table id="units_home".+?</table>')
+    unit_link = re.compile(
+        r'(?s)<a href="#" class="unit_link" data-unit="(\w+)".+?(\d+)</strong>'
+    )
+    recruit_cancel = re.compile(r"(?s)TrainOverview\.cancelOrder\((\d+)\)")
+    recruit_queue = re.compile('(?s)<div class="trainqueue_wrap"(.+?)</tbody>')
+    recruit_queue_item = re.compile(
+        r'class="unit_sprite unit_sprite_smaller (.+?)">.+?div>.+?(\d+).+<td class="lit-item">.+? (\d{2}:\d{2}:\d{2})',
+        re.M | re.S,
+    )
+    outgoing = re.compile('(?s)<div id="commands_outgoings"(.+?)</tbody>')
+    outgoing_item = re.compile(
+        r'data-command-type="(.+?)">.+?data-endtime="(\d+)"', re.M | re.S
+    )
+    quickedit_village = re.compile(r'<span class="quickedit-vn" data-id="(\d+)"')
+    production_table = re.compile('(?s)<table id="production_table"(.+?)</table>')
+    units_table = re.compile('(?s)<table id="units_table"(.+?)</table>')
+    table_head = re.compile("(?s)<thead>(.+?)</thead>")
+    table_body = re.compile(r"(?s)<tbody[^>]*>(.+?)</tbody>")
+    table_row = re.compile(r"(?s)<tr[^>]*>(.+?)</tr>")
+    overview_storage = re.compile(
+        r'(?s)class="res iron">.+?</td>\s*<td[^>]*>\s*(\d+)\s*</td>'
+    )
+    overview_farm = re.compile(r"<td[^>]*>\s*(\d+)/(\d+)\s*</td>")
+    overview_unit_header = re.compile(r"unit_(\w+)\.(?:png|webp)")
+    overview_unit_count = re.compile(r'(?s)<td class="unit-item[^"]*">\s*(\d+)')
+    village_anchor = re.compile(r'(?s)<span class="village_anchor.+?</tr>')
+    unit_item = re.compile(r"(?s)class=\Wunit-item unit-item-([a-z]+)\W.+?(\d+)</td>")
+    form_input = re.compile(r'(?s)<input.+?name="(.+?)".+?value="(.*?)"')
+    attack_duration = re.compile(r'<span class="relative_time" data-duration="(\d+)"')
+    # loot assistant template inputs, name="light[1234]" value="5"
+    farm_template_unit = re.compile(r'<input[^>]+?name="(\w+)\[(\d+)\]"[^>]*?value="(\d*)"')
+    report_link = re.compile(r'(?s)class="report-link" data-id="(\d+)"')
+    resource_amount = {
+        # amounts close to the storage limit are wrapped in a warn span
+        resource: re.compile(r'class="res %s">\s*(?:<span[^>]*>\s*)?(\d+)' % resource)
+        for resource in ["wood", "stone", "iron"]
+    }
+
+
+class ParsedPage:
+    """
+    All known structures of a single response, every structure is extracted at most once
+    WebWrapper.post_process attaches one to every response as response.parsed
+    The results are shared by every reader of the page, Extractor hands out copies
+    """
+
+    def __init__(self, text):
+        self.text = text
 
-class Extractor:
     @staticmethod
-    def new_active_building_queue(res):
-        if type(res) != str:
-            res = res.text
-        builder = re.search('(?s)<table id="build_queue"(.+?)</table>', res)
-        if builder is None:
+    def of(res):
+        if type(res) == str:
+            return ParsedPage(res)
+        parsed = getattr(res, "parsed", None)
+        if parsed is None:
+            parsed = ParsedPage(res.text)
+            try:
+                res.parsed = parsed
+            except AttributeError:
+                pass
+        return parsed
+
+    @cached_property
+    def csrf_token(self):
+        xsrf = Patterns.csrf_token.search(self.text)
+        return xsrf.group(1) if xsrf else None
+
+    @cached_property
+    def h(self):
+        get_h = Patterns.h.search(self.text)
+        return get_h.group(1) if get_h else None
+
+    @cached_property
+    def build_queue(self):
+        builder = Patterns.build_queue.search(self.text)
+        return builder.group(1) if builder else None
+
+    @cached_property
+    def new_active_building_queue(self):
+        if self.build_queue is None:
             return [], []
-        p = re.compile(
-            r'<tr class=".+? buildorder_(.+?)"[ >].+?data-available-to="(.+?)"',
-            re.M | re.S,
-        )
-        queued = re.findall(p, builder.group(1))
+        queued = Patterns.build_queue_item.findall(self.build_queue)
 
         current_ts = []
         buildings_q = []
@@ -25,139 +116,85 @@ class Extractor:
 
         return current_ts, buildings_q
 
-    @staticmethod
-    def village_data(res):
-        if type(res) != str:
-            res = res.text
-        grabber = re.search(r"var village = (.+);", res)
+    @cached_property
+    def village_data(self):
+        grabber = Patterns.village_data.search(self.text)
         if grabber:
-            data = grabber.group(1)
-            return json.loads(data, strict=False)
+            return fastjson.loads(grabber.group(1))
 
-    @staticmethod
-    def game_state(res):
-        if type(res) != str:
-            res = res.text
-        grabber = re.search(r"TribalWars\.updateGameData\((.+?)\);", res)
+    @cached_property
+    def game_state(self):
+        grabber = Patterns.game_state.search(self.text)
         if grabber:
-            data = grabber.group(1)
-            return json.loads(data, strict=False)
+            return fastjson.loads(grabber.group(1))
 
-    @staticmethod
-    def building_data(res):
-        if type(res) != str:
-            res = res.text
-        dre = re.search(r"(?s)BuildingMain.buildings = (\{.+?\});", res)
+    @cached_property
+    def building_data(self):
+        dre = Patterns.building_data.search(self.text)
         if dre:
-            return json.loads(dre.group(1), strict=False)
-
+            return fastjson.loads(dre.group(1))
         return None
 
-    @staticmethod
-    def get_quests(res):
-        if type(res) != str:
-            res = res.text
-        get_quests = re.search(r"Quests.setQuestData\((\{.+?\})\);", res)
+    @cached_property
+    def quests(self):
+        get_quests = Patterns.quests.search(self.text)
         if get_quests:
-            result = json.loads(get_quests.group(1), strict=False)
-            for quest in result:
-                data = result[quest]
-                if data["goals_completed"] == data["goals_total"]:
-                    return quest
+            return fastjson.loads(get_quests.group(1))
         return None
 
-    @staticmethod
-    def get_quest_rewards(res):
-        if type(res) != str:
-            res = res.text
-        get_rewards = re.search(r"RewardSystem\.setRewards\((\[\{.+?\}\]),", res)
-        rewards = []
+    @cached_property
+    def quest_rewards(self):
+        get_rewards = Patterns.quest_rewards.search(self.text)
         if get_rewards:
-            result = json.loads(get_rewards.group(1), strict=False)
-            for reward in result:
-                if reward["status"] == "unlocked":
-                    rewards.append(reward)
-        # Return all off them
-        return rewards
+            return fastjson.loads(get_rewards.group(1))
+        return []
 
-    @staticmethod
-    def map_data(res):
-        if type(res) != str:
-            res = res.text
-        data = re.search(r"(?s)TWMap.sectorPrefech = (\[(.+?)\]);", res)
+    @cached_property
+    def map_data(self):
+        data = Patterns.map_data.search(self.text)
         if data:
-            result = json.loads(data.group(1), strict=False)
-            return result
+            return fastjson.loads(data.group(1))
 
-    @staticmethod
-    def smith_data(res):
-        if type(res) != str:
-            res = res.text
-        data = re.search(r"(?s)BuildingSmith.techs = (\{.+?\});", res)
+    @cached_property
+    def smith_data(self):
+        data = Patterns.smith_data.search(self.text)
         if data:
-            result = json.loads(data.group(1), strict=False)
-            return result
+            return fastjson.loads(data.group(1))
         return None
 
-    @staticmethod
-    def premium_data(res):
-        if type(res) != str:
-            res = res.text
-        data = re.search(r"(?s)PremiumExchange.receiveData\((.+?)\);", res)
+    @cached_property
+    def premium_data(self):
+        data = Patterns.premium_data.search(self.text)
         if data:
-            result = json.loads(data.group(1), strict=False)
-            return result
+            return fastjson.loads(data.group(1))
         return None
 
-    @staticmethod
-    def recruit_data(res):
-        if type(res) != str:
-            res = res.text
-        data = re.search(r"(?s)unit_managers.units = (\{.+?\});", res)
+    @cached_property
+    def recruit_data(self):
+        data = Patterns.recruit_data.search(self.text)
         if data:
-            raw = data.group(1)
-            quote_keys_regex = r"([\{\s,])(\w+)(:)"
-            processed = re.sub(quote_keys_regex, r'\1"\2"\3', raw)
-            result = json.loads(processed, strict=False)
-            return result
+            processed = Patterns.quote_keys.sub(r'\1"\2"\3', data.group(1))
+            return fastjson.loads(processed)
 
-    @staticmethod
-    def units_in_village(res):
-        if type(res) != str:
-            res = res.text
-        res = re.sub('(?s)<table id="units_home".+?</table>', "", res)
-        data = re.findall(
-            r'(?s)<a href="#" class="unit_link" data-unit="(\w+)".+?(\d+)</strong>', res
-        )
-        return data
+    @cached_property
+    def units_in_village(self):
+        res = Patterns.units_home.sub("", self.text)
+        return Patterns.unit_link.findall(res)
 
-    @staticmethod
-    def active_building_queue(res):
-        if type(res) != str:
-            res = res.text
-        builder = re.search('(?s)<table id="build_queue"(.+?)</table>', res)
-        if not builder:
+    @cached_property
+    def active_building_queue(self):
+        if not self.build_queue:
             return 0
+        return self.build_queue.count('<a class="btn btn-cancel"')
 
-        return builder.group(1).count('<a class="btn btn-cancel"')
-
-    @staticmethod
-    def active_recruit_queue(res):
-        if type(res) != str:
-            res = res.text
-        builder = re.findall(r"(?s)TrainOverview\.cancelOrder\((\d+)\)", res)
-        return builder
+    @cached_property
+    def active_recruit_queue(self):
+        return Patterns.recruit_cancel.findall(self.text)
 
-    @staticmethod
-    def new_active_recruit_queue(res):
-        if type(res) != str:
-            res = res.text
-        builder = re.search('(?s)<div class="trainqueue_wrap"(.+?)<\/tbody>', res)
-        p = re.compile(
-            r'class="unit_sprite unit_sprite_smaller (.+?)">.+?div>.+?(\d+).+<td class="lit-item">.+? (\d{2}:\d{2}:\d{2})',
-            re.M | re.S,
-        )
-        queued = re.findall(p, builder.group(1))
+    @cached_property
+    def new_active_recruit_queue(self):
+        builder = Patterns.recruit_queue.search(self.text)
+        queued = Patterns.recruit_queue_item.findall(builder.group(1))
         previous_time = None
         current_ts = []
         units_q = []
@@ -176,17 +213,12 @@ class Extractor:
 
         return current_ts, units_q
 
-    @staticmethod
-    def active_attacks(res):
-        if type(res) != str:
-            res = res.text
-        builder = re.search('(?s)<div id="commands_outgoings"(.+?)<\/tbody>', res)
+    @cached_property
+    def active_attacks(self):
+        builder = Patterns.outgoing.search(self.text)
         if not builder:
             return [], []
-        p = re.compile(
-            r'data-command-type="(.+?)">.+?data-endtime="(\d+)"', re.M | re.S
-        )
-        queued = re.findall(p, builder.group(1))
+        queued = Patterns.outgoing_item.findall(builder.group(1))
         outgoing = []
         returning = []
         for attack_or_return, timestr in queued:
@@ -197,43 +229,199 @@ class Extractor:
 
         return outgoing, returning
 
+    @cached_property
+    def village_ids_from_overview(self):
+        return list(set(Patterns.quickedit_village.findall(self.text)))
+
+    @cached_property
+    def overview_production(self):
+        res = self.text.replace('<span class="grey">.</span>', "")
+        output = {}
+        table = Patterns.production_table.search(res)
+        if not table:
+            return output
+        for row in Patterns.table_row.findall(table.group(1)):
+            vid = Patterns.quickedit_village.search(row)
+            if not vid:
+                continue
+            entry = {"incoming": row.count("command/attack.png")}
+            for resource, pattern in Patterns.resource_amount.items():
+                amount = pattern.search(row)
+                # left out when unreadable, the village then loads its own overview page
+                if amount:
+                    entry[resource] = int(amount.group(1))
+            storage = Patterns.overview_storage.search(row)
+            if storage:
+                entry["storage_max"] = int(storage.group(1))
+            farm = Patterns.overview_farm.search(row)
+            if farm:
+                entry["pop"] = int(farm.group(1))
+                entry["pop_max"] = int(farm.group(2))
+            output[vid.group(1)] = entry
+        return output
+
+    @cached_property
+    def overview_units(self):
+        output = {}
+        table = Patterns.units_table.search(self.text)
+        if not table:
+            return output
+        header = Patterns.table_head.search(table.group(1))
+        if not header:
+            return output
+        units = Patterns.overview_unit_header.findall(header.group(1))
+        for body in Patterns.table_body.findall(table.group(1)):
+            vid = Patterns.quickedit_village.search(body)
+            if not vid:
+                continue
+            rows = []
+            for row in Patterns.table_row.findall(body):
+                counts = Patterns.overview_unit_count.findall(row)
+                if len(counts) == len(units):
+                    rows.append(dict(zip(units, [int(x) for x in counts])))
+            if not rows:
+                continue
+            # first row: own units at home, last row: total including units away
+            output[vid.group(1)] = {"home": rows[0], "total": rows[-1]}
+        return output
+
+    @cached_property
+    def units_in_total(self):
+        # hide units from other villages
+        res = Patterns.village_anchor.sub("", self.text)
+        return Patterns.unit_item.findall(res)
+
+    @cached_property
+    def attack_form(self):
+        return Patterns.form_input.findall(self.text)
+
+    @cached_property
+    def farm_templates(self):
+        # template id -> units, in page order (A first, then B)
+        output = {}
+        for unit, template_id, amount in Patterns.farm_template_unit.findall(self.text):
+            if template_id not in output:
+                output[template_id] = {}
+            output[template_id][unit] = int(amount) if amount else 0
+        return output
+
+    @cached_property
+    def attack_duration(self):
+        data = Patterns.attack_duration.search(self.text)
+        if data:
+            return int(data.group(1))
+        return 0
+
+    @cached_property
+    def report_table(self):
+        return Patterns.report_link.findall(self.text)
+
+
+class Extractor:
+    @staticmethod
+    def new_active_building_queue(res):
+        current_ts, buildings_q = ParsedPage.of(res).new_active_building_queue
+        # callers modify these lists
+        return list(current_ts), list(buildings_q)
+
+    @staticmethod
+    def village_data(res):
+        return copy.deepcopy(ParsedPage.of(res).village_data)
+
+    @staticmethod
+    def game_state(res):
+        return copy.deepcopy(ParsedPage.of(res).game_state)
+
+    @staticmethod
+    def building_data(res):
+        return copy.deepcopy(ParsedPage.of(res).building_data)
+
+    @staticmethod
+    def get_quests(res):
+        result = ParsedPage.of(res).quests
+        if result:
+            for quest in result:
+                data = result[quest]
+                if data["goals_completed"] == data["goals_total"]:
+                    return quest
+        return None
+
+    @staticmethod
+    def get_quest_rewards(res):
+        rewards = []
+        for reward in ParsedPage.of(res).quest_rewards:
+            if reward["status"] == "unlocked":
+                rewards.append(copy.deepcopy(reward))
+        # Return all off them
+        return rewards
+
+    @staticmethod
+    def map_data(res):
+        return copy.deepcopy(ParsedPage.of(res).map_data)
+
+    @staticmethod
+    def smith_data(res):
+        return copy.deepcopy(ParsedPage.of(res).smith_data)
+
+    @staticmethod
+    def premium_data(res):
+        return copy.deepcopy(ParsedPage.of(res).premium_data)
+
+    @staticmethod
+    def recruit_data(res):
+        return copy.deepcopy(ParsedPage.of(res).recruit_data)
+
+    @staticmethod
+    def units_in_village(res):
+        return list(ParsedPage.of(res).units_in_village)
+
+    @staticmethod
+    def active_building_queue(res):
+        return ParsedPage.of(res).active_building_queue
+
+    @staticmethod
+    def active_recruit_queue(res):
+        return list(ParsedPage.of(res).active_recruit_queue)
+
+    @staticmethod
+    def new_active_recruit_queue(res):
+        current_ts, units_q = ParsedPage.of(res).new_active_recruit_queue
+        return list(current_ts), list(units_q)
+
+    @staticmethod
+    def active_attacks(res):
+        outgoing, returning = ParsedPage.of(res).active_attacks
+        # callers modify these lists
+        return list(outgoing), list(returning)
+
     @staticmethod
     def village_ids_from_overview(res):
-        if type(res) != str:
-            res = res.text
-        villages = re.findall(r'<span class="quickedit-vn" data-id="(\d+)"', res)
-        return list(set(villages))
+        return list(ParsedPage.of(res).village_ids_from_overview)
+
+    @staticmethod
+    def overview_production(res):
+        return copy.deepcopy(ParsedPage.of(res).overview_production)
+
+    @staticmethod
+    def overview_units(res):
+        return copy.deepcopy(ParsedPage.of(res).overview_units)
 
     @staticmethod
     def units_in_total(res):
-        if type(res) != str:
-            res = res.text
-        # hide units from other villages
-        res = re.sub(r'(?s)<span class="village_anchor.+?</tr>', "", res)
-        data = re.findall(
-            r"(?s)class=\Wunit-item unit-item-([a-z]+)\W.+?(\d+)</td>", res
-        )
-        return data
+        return list(ParsedPage.of(res).units_in_total)
 
     @staticmethod
     def attack_form(res):
-        if type(res) != str:
-            res = res.text
-        data = re.findall(r'(?s)<input.+?name="(.+?)".+?value="(.*?)"', res)
-        return data
+        return list(ParsedPage.of(res).attack_form)
+
+    @staticmethod
+    def farm_templates(res):
+        return {k: dict(v) for k, v in ParsedPage.of(res).farm_templates.items()}
 
     @staticmethod
     def attack_duration(res):
-        if type(res) != str:
-            res = res.text
-        data = re.search(r'<span class="relative_time" data-duration="(\d+)"', res)
-        if data:
-            return int(data.group(1))
-        return 0
+        return ParsedPage.of(res).attack_duration
 
     @staticmethod
     def report_table(res):
-        if type(res) != str:
-            res = res.text
-        data = re.findall(r'(?s)class="report-link" data-id="(\d+)"', res)
-        return data
\ No newline at end of file
+        return list(ParsedPage.of(res).report_table)
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import sys
+import timeit
+
+# orjson or ujson are used when installed, they are a lot faster on the big map and game state blobs
+try:
+    import orjson
+
+    has_orjson = True
+except ImportError:
+    has_orjson = False
+
+try:
+    import ujson
+
+    has_ujson = True
+except ImportError:
+    has_ujson = False
+
+logger = logging.getLogger("FastJSON")
+
+
+def stdlib_loads(data):
+    return json.loads(data, strict=False)
+
+
+def get_backends():
+    backends = {}
+    if has_orjson:
+        backends["orjson"] = orjson.loads
+    if has_ujson:
+        backends["ujson"] = ujson.loads
+    backends["json"] = stdlib_loads
+    return backends
+
+
+backends = get_backends()
+backend = list(backends.keys())[0]
+_fast_loads = backends[backend]
+
+
+def loads(data):
+    try:
+        return _fast_loads(data)
+    except ValueError:
+        # the fast decoders are strict, game data can contain raw control characters
+        return stdlib_loads(data)
+
+
+def benchmark(fixture_dir, number=20):
+    """
+    Decode time per page type for every available backend
+    Fixtures are saved game pages (html) or JSON responses, named after the page type (map.html, main.html)
+    """
+    from core.extractors import Patterns
+
+    blob_patterns = {
+        "game_state": Patterns.game_state,
+        "map_data": Patterns.map_data,
+        "building_data": Patterns.building_data,
+        "recruit_data": Patterns.recruit_data,
+        "premium_data": Patterns.premium_data,
+        "smith_data": Patterns.smith_data,
+        "village_data": Patterns.village_data,
+    }
+    output = []
+    for fixture in sorted(os.listdir(fixture_dir)):
+        with open(os.path.join(fixture_dir, fixture), "r", encoding="utf-8") as f:
+            text = f.read()
+        blobs = {}
+        if fixture.endswith(".json"):
+            blobs["response"] = text
+        for name, pattern in blob_patterns.items():
+            found = pattern.search(text)
+            if not found:
+                continue
+            raw = found.group(1)
+            if name == "recruit_data":
+                raw = Patterns.quote_keys.sub(r'\1"\2"\3', raw)
+            blobs[name] = raw
+        for name, raw in blobs.items():
+            timings = {}
+            for backend_name, func in backends.items():
+
+                def run():
+                    try:
+                        return func(raw)
+                    except ValueError:
+                        return stdlib_loads(raw)
+
+                timings[backend_name] = timeit.timeit(run, number=number) / number
+            output.append((fixture, name, len(raw), timings))
+    return output
+
+
+if __name__ == "__main__":
+    fixtures = sys.argv[1] if len(sys.argv) > 1 else os.path.join("cache", "fixtures")
+    if not os.path.exists(fixtures):
+        print("No fixtures found in %s, save some game pages there first" % fixtures)
+        sys.exit(1)
+    print("Available backends: %s (using %s)" % (", ".join(backends), backend))
+    for fixture, name, size, timings in benchmark(fixtures):
+        print(
+            "%s %s (%d KB): %s"
+            % (
+                fixture,
+                name,
+                size / 1024,
+                ", ".join("%s %.3f ms" % (k, v * 1000) for k, v in timings.items()),
+            )
+        )
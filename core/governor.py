@@ -0,0 +1,70 @@
+import logging
+import random
+import threading
+import time
+
+
+class RequestGovernor:
+    """
+    Token bucket shared by every request the bot makes
+    Requests only wait when the budget is used up, background requests leave a reserve for the others
+    """
+
+    INTERACTIVE = "interactive"
+    TIMED = "timed"
+    BACKGROUND = "background"
+
+    logger = logging.getLogger("Governor")
+
+    def __init__(self, rate=12, burst=5, jitter=1.0, background_reserve=2):
+        # rate in requests per minute
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.background_reserve = background_reserve
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+        self.stats = {}
+        for priority in [self.INTERACTIVE, self.TIMED, self.BACKGROUND]:
+            self.stats[priority] = {"requests": 0, "waits": 0, "waited": 0.0}
+
+    def refill(self, factor=1.0):
+        now = time.time()
+        per_second = self.rate / 60.0 / (factor if factor > 0 else 1.0)
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * per_second)
+        self.last_refill = now
+        return per_second
+
+    def acquire(self, priority=INTERACTIVE, factor=1.0):
+        if priority not in self.stats:
+            priority = self.INTERACTIVE
+        needed = 1.0
+        if priority == self.BACKGROUND:
+            # never ask for more than the bucket can hold
+            needed = max(needed, min(self.burst, needed + self.background_reserve))
+        waited = 0.0
+        while True:
+            with self.lock:
+                per_second = self.refill(factor)
+                # timed attacks never wait, they pay for it afterwards
+                if priority == self.TIMED or self.tokens >= needed:
+                    self.tokens -= 1
+                    stats = self.stats[priority]
+                    stats["requests"] += 1
+                    if waited:
+                        stats["waits"] += 1
+                        stats["waited"] += waited
+                    return waited
+                wait = (needed - self.tokens) / per_second
+            wait += random.uniform(0, self.jitter)
+            time.sleep(wait)
+            waited += wait
+
+    def summary(self):
+        with self.lock:
+            return ", ".join(
+                "%s: %d requests, waited %d times (%.1f sec)"
+                % (k, v["requests"], v["waits"], v["waited"])
+                for k, v in self.stats.items()
+            )
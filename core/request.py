@@ -1,18 +1,95 @@
 import requests
 try:
-    from urllib.parse import urljoin, urlencode
+    from urllib.parse import urljoin, urlencode, urlsplit, parse_qsl
 except ImportError:
-    from urlparse import urljoin, urlencode
+    from urlparse import urljoin, urlencode, urlsplit, parse_qsl
 import logging
-import re
 import time
-import random
 import json
 import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core.extractors import ParsedPage
+from core.governor import RequestGovernor
 from core.reporter import ReporterObject
 from core.notifier import DiscordNotifier
 
 
+class PageCache:
+    """
+    Short lived cache for game pages, keyed by normalized url and village
+    Every POST (or GET that performs an action) drops the entries of that village
+    """
+
+    # query parameters that do not change the page content
+    volatile = ["h", "_"]
+    # query parameters that make a GET request perform an action
+    actions = ["action", "ajaxaction"]
+    # screens that are always loaded fresh (new reports, bulk overviews of every village)
+    fresh_screens = ["report", "overview_villages"]
+    logger = logging.getLogger("PageCache")
+
+    def __init__(self, ttl=120):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, url):
+        parts = urlsplit(url)
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        village = None
+        screen = None
+        for k, v in params:
+            if k == "village":
+                village = v
+            if k == "screen":
+                screen = v
+        key = "%s?%s" % (
+            parts.path,
+            urlencode(sorted([x for x in params if x[0] not in self.volatile])),
+        )
+        is_action = any(k in self.actions for k, v in params)
+        return village, key, is_action, screen in self.fresh_screens
+
+    def get(self, url):
+        village, key, is_action, fresh = self.parse(url)
+        if is_action:
+            self.invalidate(village)
+            return None
+        if fresh:
+            return None
+        entry = self.entries.get(village, {}).get(key)
+        if entry and entry[0] + self.ttl > time.time():
+            self.hits += 1
+            self.logger.debug("Cache hit for %s" % url)
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, url, response):
+        village, key, is_action, fresh = self.parse(url)
+        if is_action or fresh or response.status_code != 200:
+            return
+        if village not in self.entries:
+            self.entries[village] = {}
+        self.entries[village][key] = (time.time(), response)
+
+    def invalidate(self, village=None):
+        if not village:
+            self.entries = {}
+            return
+        self.entries.pop(village, None)
+        # Pages without a village id (overviews) can depend on any village
+        self.entries.pop(None, None)
+
+    def invalidate_url(self, url):
+        village, key, is_action, fresh = self.parse(url)
+        self.invalidate(village)
+
+
 class WebWrapper:
     web = None
     headers = {
@@ -31,9 +108,19 @@ class WebWrapper:
     discord = None
     discord_notifier = None
     proxy = {}
+    page_cache = None
+    governor = None
+    concurrent = None
+    lock = None
 
-    def __init__(self, url, server=None, endpoint=None, reporter_enabled=False, reporter_constr=None, discord=None, discord_endpoint=None, discord_notifier=None, discord_notifier_endpoint=None, proxy_enabled=False, proxy_endpoint=None):
+    def __init__(self, url, server=None, endpoint=None, reporter_enabled=False, reporter_constr=None, discord=None, discord_endpoint=None, discord_notifier=None, discord_notifier_endpoint=None, proxy_enabled=False, proxy_endpoint=None, page_cache_ttl=0, request_rate=12, request_burst=5, request_jitter=1.0, max_in_flight=1):
         self.web = requests.session()
+        self.lock = threading.RLock()
+        if max_in_flight > 1:
+            self.concurrent = AsyncWebWrapper(self, max_in_flight=max_in_flight)
+        self.governor = RequestGovernor(rate=request_rate, burst=request_burst, jitter=request_jitter)
+        if page_cache_ttl:
+            self.page_cache = PageCache(ttl=page_cache_ttl)
         if proxy_enabled and proxy_endpoint:
             self.proxy['http'] = proxy_endpoint
             self.proxy['https'] = proxy_endpoint
@@ -54,49 +141,75 @@ class WebWrapper:
         input("If IP is correct press any key to continue...")
 
     def post_process(self, response):
-        xsrf = re.search('<meta content="(.+?)" name="csrf-token"', response.text)
-        if xsrf:
-            self.headers['x-csrf-token'] = xsrf.group(1)
-            self.logger.debug("Set CSRF token")
-        elif 'x-csrf-token' in self.headers:
-            del self.headers['x-csrf-token']
-        self.headers['Referer'] = response.url
-        self.last_response = response
-        get_h = re.search(r'&h=(\w+)', response.text)
-        if get_h:
-            self.last_h = get_h.group(1)
-
-    def get_url(self, url, headers=None):
+        page = ParsedPage.of(response)
+        with self.lock:
+            if page.csrf_token:
+                self.headers['x-csrf-token'] = page.csrf_token
+                self.logger.debug("Set CSRF token")
+            elif 'x-csrf-token' in self.headers:
+                del self.headers['x-csrf-token']
+            self.headers['Referer'] = response.url
+            self.last_response = response
+            if page.h:
+                self.last_h = page.h
+
+    def clear_page_cache(self, village_id=None):
+        if self.page_cache is not None:
+            with self.lock:
+                self.page_cache.invalidate(village_id)
+
+    def throttle(self, priority=None):
+        if not priority:
+            priority = RequestGovernor.TIMED if self.priority_mode else RequestGovernor.INTERACTIVE
+        waited = self.governor.acquire(priority=priority, factor=self.delay)
+        if waited:
+            self.logger.debug("Waited %.1f seconds for request budget (%s)" % (waited, priority))
+
+    def get_url(self, url, headers=None, priority=None):
         self.headers['Origin'] = (self.endpoint if self.endpoint else self.auth_endpoint).rstrip('/')
-        if not self.priority_mode:
-            time.sleep(random.randint(int(3 * self.delay), int(7 * self.delay)))
         url = urljoin(self.endpoint if self.endpoint else self.auth_endpoint, url)
+        # only plain page loads are cached, api calls use custom headers
+        use_cache = self.page_cache is not None and not headers
+        if use_cache:
+            with self.lock:
+                cached = self.page_cache.get(url)
+            if cached is not None:
+                self.post_process(cached)
+                return cached
+        self.throttle(priority)
         if not headers:
-            headers = self.headers
+            with self.lock:
+                headers = dict(self.headers)
         try:
             res = self.web.get(url=url, headers=headers)
             self.logger.debug("GET %s [%d]" % (url, res.status_code))
             self.post_process(res)
+            if use_cache and 'data-bot-protect="forced"' not in res.text:
+                with self.lock:
+                    self.page_cache.put(url, res)
             if 'data-bot-protect="forced"' in res.text:
                 msg = "Bot protection hit! Cannot continue. Solve captcha and restart"
                 self.logger.warning(msg)
                 self.discord.send(msg)
                 self.reporter.report(0, "TWB_RECAPTCHA", "Stopping bot, press any key once captcha has been solved")
                 input("Press any key...")
-                return self.get_url(url, headers)
+                return self.get_url(url, headers, priority)
             return res
         except Exception as e:
             self.logger.warning("GET %s: %s" % (url, str(e)))
             return None
 
-    def post_url(self, url, data, headers=None):
-        if not self.priority_mode:
-            time.sleep(random.randint(int(3 * self.delay), int(7 * self.delay)))
+    def post_url(self, url, data, headers=None, priority=None):
+        self.throttle(priority)
         self.headers['Origin'] = (self.endpoint if self.endpoint else self.auth_endpoint).rstrip('/')
         url = urljoin(self.endpoint if self.endpoint else self.auth_endpoint, url)
         enc = urlencode(data)
+        if self.page_cache is not None:
+            with self.lock:
+                self.page_cache.invalidate_url(url)
         if not headers:
-            headers = self.headers
+            with self.lock:
+                headers = dict(self.headers)
         try:
             res = self.web.post(url=url, data=data, headers=headers)
             self.logger.debug("POST %s %s [%d]" % (url, enc, res.status_code))
@@ -142,6 +255,12 @@ class WebWrapper:
             }
             json.dump(session, f)
 
+    def get_urls(self, urls, priority=None):
+        # independent reads, overlapping when a concurrency pool is configured
+        if self.concurrent:
+            return self.concurrent.fetch_all(urls, priority=priority)
+        return [self.get_url(url, priority=priority) for url in urls]
+
     def get_action(self, village_id, action):
         url = "game.php?village=%s&screen=%s" % (village_id, action)
         response = self.get_url(url)
@@ -149,7 +268,8 @@ class WebWrapper:
 
     def get_api_data(self, village_id, action, params={}):
 
-        custom = dict(self.headers)
+        with self.lock:
+            custom = dict(self.headers)
         custom['accept'] = "application/json, text/javascript, */*; q=0.01"
         custom['x-requested-with'] = "XMLHttpRequest"
         custom['tribalwars-ajax'] = "1"
@@ -170,7 +290,8 @@ class WebWrapper:
 
     def post_api_data(self, village_id, action, params={}, data={}):
 
-        custom = dict(self.headers)
+        with self.lock:
+            custom = dict(self.headers)
         custom['accept'] = "application/json, text/javascript, */*; q=0.01"
         custom['x-requested-with'] = "XMLHttpRequest"
         custom['tribalwars-ajax'] = "1"
@@ -193,7 +314,8 @@ class WebWrapper:
 
     def get_api_action(self, village_id, action, params={}, data={}):
 
-        custom = dict(self.headers)
+        with self.lock:
+            custom = dict(self.headers)
         custom['accept'] = "application/json, text/javascript, */*; q=0.01"
         custom['x-requested-with'] = "XMLHttpRequest"
         custom['tribalwars-ajax'] = "1"
@@ -213,3 +335,55 @@ class WebWrapper:
                 return res.json()
             except:
                 return res
+
+
+class AsyncWebWrapper:
+    """
+    asyncio front-end for WebWrapper, requests run on a bounded thread pool
+    Session, CSRF token, last_h and the request budget are shared with the wrapped WebWrapper
+    """
+
+    def __init__(self, wrapper, max_in_flight=4):
+        self.wrapper = wrapper
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="twb-request"
+        )
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def get_url(self, url, headers=None, priority=None):
+        return await self.run(self.wrapper.get_url, url, headers=headers, priority=priority)
+
+    async def post_url(self, url, data, headers=None, priority=None):
+        return await self.run(
+            self.wrapper.post_url, url, data, headers=headers, priority=priority
+        )
+
+    async def get_action(self, village_id, action):
+        return await self.run(self.wrapper.get_action, village_id, action)
+
+    async def get_api_data(self, village_id, action, params={}):
+        return await self.run(self.wrapper.get_api_data, village_id, action, params=params)
+
+    async def post_api_data(self, village_id, action, params={}, data={}):
+        return await self.run(
+            self.wrapper.post_api_data, village_id, action, params=params, data=data
+        )
+
+    async def get_api_action(self, village_id, action, params={}, data={}):
+        return await self.run(
+            self.wrapper.get_api_action, village_id, action, params=params, data=data
+        )
+
+    async def get_urls(self, urls, priority=None):
+        return await asyncio.gather(
+            *[self.get_url(url, priority=priority) for url in urls]
+        )
+
+    def fetch_all(self, urls, priority=None):
+        return asyncio.run(self.get_urls(urls, priority=priority))
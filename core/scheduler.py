@@ -0,0 +1,83 @@
+import heapq
+import logging
+import time
+
+
+class EventScheduler:
+    """
+    Priority queue of per-village events (building, recruit_*, gather, back, outgoing)
+    Only villages with due events get woken up, a full sweep is still done every sweep_interval seconds
+    Every village also gets a complete re-check recheck_interval seconds after its last run, as a safety net
+    for work that has no event (resources that were short, farms that are off cooldown, quests, research)
+    """
+
+    # event kind -> Village manager functions that have to run when the event fires
+    event_managers = {
+        "building": ["builder", "market"],
+        "recruit_barracks": ["recruit"],
+        "recruit_stable": ["recruit"],
+        "recruit_garage": ["recruit"],
+        "gather": ["attacks"],
+        "back": ["attacks"],
+        "outgoing": ["attacks"],
+        # runs every manager
+        "recheck": None,
+    }
+
+    sweep_interval = 3600
+    recheck_interval = 1800
+    # events this close to each other are handled in the same wake-up
+    grace = 30
+    logger = logging.getLogger("Scheduler")
+
+    def __init__(self, sweep_interval=3600, recheck_interval=1800):
+        self.sweep_interval = sweep_interval
+        self.recheck_interval = recheck_interval
+        self.queue = []
+        self.last_sweep = 0
+
+    def clear(self, village_id):
+        self.queue = [entry for entry in self.queue if entry[1] != village_id]
+        heapq.heapify(self.queue)
+
+    def schedule(self, village_id, kind, at):
+        if not at or kind not in self.event_managers:
+            return
+        heapq.heappush(self.queue, (at, village_id, kind))
+
+    def schedule_village(self, village):
+        self.clear(village.village_id)
+        for kind, at in village.upcoming_events.items():
+            self.schedule(village.village_id, kind, at)
+        self.schedule(village.village_id, "recheck", time.time() + self.recheck_interval)
+
+    def sweep_due(self):
+        return self.last_sweep + self.sweep_interval <= time.time()
+
+    def swept(self):
+        self.last_sweep = time.time()
+
+    def pop_due(self):
+        """
+        Returns a dict village_id -> set of manager names for every event that is due
+        None instead of a set means the village needs a complete run
+        """
+        output = {}
+        now = time.time() + self.grace
+        while self.queue and self.queue[0][0] <= now:
+            at, village_id, kind = heapq.heappop(self.queue)
+            self.logger.debug("Event %s for village %s is due" % (kind, village_id))
+            if self.event_managers[kind] is None:
+                output[village_id] = None
+                continue
+            if village_id not in output:
+                output[village_id] = set()
+            if output[village_id] is not None:
+                output[village_id].update(self.event_managers[kind])
+        return output
+
+    def seconds_till_next_wake(self):
+        next_wake = self.last_sweep + self.sweep_interval
+        if self.queue and self.queue[0][0] < next_wake:
+            next_wake = self.queue[0][0]
+        return max(0, next_wake - time.time())
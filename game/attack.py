@@ -1,13 +1,19 @@
+import atexit
+import math
 import time
 import os
 import json
+import threading
 from core.extractors import Extractor
 import logging
 import time
 from datetime import datetime
 from datetime import timedelta
 
+from game.map import WorldMap
+from game.planner import FarmPlanner
 from game.reports import ReportCache, ReportManager
+from game.simulator import Simulator
 
 
 class AttackManager:
@@ -28,6 +34,34 @@ class AttackManager:
     farm_minpoints = 0
     farm_maxpoints = 1000
     ignored = []
+    # get_targets filters that only depend on the map and the settings
+    static_targets = []
+    static_key = None
+    # world speed * unit speed, used for the travel time estimates
+    world_speed = 1
+    # template key -> {vid: one way travel time in seconds}
+    travel_times = {}
+    # send farms with the loot assistant (am_farm) templates instead of the rally point
+    loot_assistant = False
+    # template key -> loot assistant template id
+    la_templates = {}
+    # templates used in the current run
+    active_template = None
+    # shrink farm templates to the units needed to carry the expected haul
+    carry_sizing = False
+    # extra carry capacity on top of the expected haul
+    carry_margin = 1.2
+    # never plan for less than this haul
+    min_farm_carry = 100
+    # vid -> expected haul or None, refreshed every run
+    expected_loot = {}
+    # send the cheapest army that clears farms where the scout report found defenders
+    clear_defended = False
+    # part of the army value that may be lost clearing a farm
+    clear_max_losses = 0.1
+    # "food" (population) or "resources"
+    clear_cost = "food"
+    sim = Simulator()
 
     forced_peace_time = None
 
@@ -60,17 +94,40 @@ class AttackManager:
             if self.troopmanager.troops == {}:
                 self.logger.warning("No troops in village at all!")
                 return False
+        self.active_template = self.farm_templates()
         self.get_targets()
-        self.priority_targets = self.repman.priority_farms(self.targets)
+        templates = self.active_template
+        if type(templates) != list:
+            templates = [templates]
+        speed = self.troopmanager.template_speed(templates[0]) if templates[0] else 0
+        if FarmPlanner.enabled:
+            FarmPlanner.register(
+                self.village_id,
+                self.targets,
+                self.farm_capacity(templates),
+                speed,
+                blocked=[
+                    target["id"]
+                    for target, distance in self.targets
+                    if not self.farm_ready(target["id"])
+                ],
+            )
+            self.targets = FarmPlanner.filter_targets(self.village_id, self.targets)
+        self.priority_targets = self.repman.priority_farms(self.targets, speed=speed or 1)
+        self.expected_loot = (
+            self.repman.expected_loot(self.targets[0 : self.max_farms])
+            if self.carry_sizing
+            else {}
+        )
         if len(self.priority_targets) > 0:
             self.logger.info(f"Found {len(self.priority_targets)} priority targets!!!")
         ignored = []
         attacked = []
         # Priority targets first
         for target in self.priority_targets[0 : self.max_farms]:
-            if type(self.template) == list:
+            if type(self.active_template) == list:
                 f = False
-                for template in self.template:
+                for template in self.active_template:
                     if template in ignored:
                         continue
                     out_res = self.send_farm(target, template)
@@ -83,16 +140,16 @@ class AttackManager:
                 if not f:
                     continue
             else:
-                out_res = self.send_farm(target, self.template)
+                out_res = self.send_farm(target, self.active_template)
                 if out_res == -1:
                     break
 
         for target in self.targets[0 : self.max_farms]:
             if target in self.priority_targets:
                 continue  # Don't farm the prio again
-            if type(self.template) == list:
+            if type(self.active_template) == list:
                 f = False
-                for template in self.template:
+                for template in self.active_template:
                     if template in ignored:
                         continue
                     out_res = self.send_farm(target, template)
@@ -105,7 +162,7 @@ class AttackManager:
                 if not f:
                     continue
             else:
-                out_res = self.send_farm(target, self.template)
+                out_res = self.send_farm(target, self.active_template)
                 if out_res == -1:
                     break
         if self.troopmanager.can_scout:
@@ -161,10 +218,99 @@ class AttackManager:
                         # All done for some reason
                         break
 
+    def farm_capacity(self, templates):
+        # how many farms the troops in the village can send with the best template
+        capacity = 0
+        for template in templates:
+            if not template:
+                continue
+            counts = [
+                int(self.troopmanager.troops.get(unit, 0)) // int(amount)
+                for unit, amount in template.items()
+                if int(amount) > 0
+            ]
+            if counts:
+                capacity = max(capacity, min(counts))
+        return min(capacity, self.max_farms)
+
+    def farm_templates(self):
+        if not self.loot_assistant:
+            return self.template
+        res = self.wrapper.get_url("game.php?village=%s&screen=am_farm" % self.village_id)
+        self.la_templates = {}
+        output = []
+        for template_id, units in Extractor.farm_templates(res).items():
+            units = {
+                unit: amount
+                for unit, amount in units.items()
+                if unit in self.troopmanager.unit_speeds and amount > 0
+            }
+            if units:
+                self.la_templates[self.template_key(units)] = template_id
+                output.append(units)
+        if not output:
+            self.logger.warning(
+                "No loot assistant templates found for village %s, using the rally point"
+                % self.village_id
+            )
+            return self.template
+        return output
+
+    def send_loot_assistant(self, vid, template_id):
+        # one request per farm instead of the rally point, confirm and send requests
+        result = self.wrapper.get_api_action(
+            village_id=self.village_id,
+            action="farm",
+            params={"screen": "am_farm", "mode": "farm"},
+            data={"target": vid, "template_id": template_id, "source": self.village_id},
+        )
+        if type(result) != dict or "error" in result:
+            self.logger.debug(
+                "Loot assistant farm %s -> %s failed: %s"
+                % (self.village_id, vid, result.get("error") if type(result) == dict else result)
+            )
+            return False
+        self.logger.info(
+            "[Loot assistant] %s -> %s (template %s)" % (self.village_id, vid, template_id)
+        )
+        return result
+
+    def size_template(self, vid, template):
+        """
+        Smallest part of the template that still carries the expected haul of the farm
+        Units that carry the most are used first, units that carry nothing (scouts, rams) are always kept
+        """
+        expected = self.expected_loot.get(vid)
+        if not self.carry_sizing or expected is None:
+            return template
+        if self.loot_assistant and self.template_key(template) in self.la_templates:
+            return template
+        needed = max(expected * self.carry_margin, self.min_farm_carry)
+        carry = self.troopmanager.unit_carry
+        output = {}
+        for unit in sorted(template, key=lambda x: carry.get(x, 0), reverse=True):
+            amount = template[unit]
+            if carry.get(unit, 0) == 0:
+                output[unit] = amount
+                continue
+            if needed <= 0:
+                continue
+            use = min(amount, int(math.ceil(needed / carry[unit])))
+            output[unit] = use
+            needed -= use * carry[unit]
+        return output
+
     def send_farm(self, target, template):
         target, distance = target
-        missing = self.enough_in_village(template)
+        sized = self.size_template(target["id"], template)
+        missing = self.enough_in_village(sized)
         if not missing:
+            if self.arrives_in_peace(target["id"], template):
+                self.logger.debug(
+                    "Not attacking %s, the attack would arrive after the forced peace timer"
+                    % target["id"]
+                )
+                return 0
             is_priority = target in self.priority_targets
             if is_priority:
                 self.logger.debug("Attacking priority target!!")
@@ -181,6 +327,7 @@ class AttackManager:
             else:
                 cached = self.can_attack(vid=target["id"], clear=False)
 
+            template = sized
             if cached:
                 attack_result = self.attack(target["id"], troops=template)
                 if attack_result == "forced_peace":
@@ -228,15 +375,18 @@ class AttackManager:
             return -1
         return 0
 
-    def get_targets(self):
+    def get_static_targets(self):
+        """
+        Targets within farm_radius that pass the filters which only change when the map or the settings change
+        """
         output = []
         my_village = (
             self.map.villages[self.village_id]
             if self.village_id in self.map.villages
             else None
         )
-        for vid in self.map.villages:
-            village = self.map.villages[vid]
+        for village, distance in self.map.within(self.farm_radius):
+            vid = village["id"]
             if village["owner"] != "0" and vid not in self.extra_farm:
                 if vid not in self.ignored:
                     self.logger.debug(
@@ -281,34 +431,72 @@ class AttackManager:
                         )
                         self.ignored.append(vid)
                     continue
-                if vid in self._unknown_ignored:
-                    continue
+            if vid in self.ignored:
+                self.logger.debug("Removed %s from farm ignore list" % vid)
+                self.ignored.remove(vid)
+            output.append([village, distance])
+        return output
+
+    def get_targets(self):
+        static_key = (
+            self.map.version,
+            tuple(self.map.my_location or []),
+            tuple(self.extra_farm),
+            self.farm_radius,
+            self.farm_minpoints,
+            self.farm_maxpoints,
+            self.target_high_points,
+        )
+        if static_key != self.static_key:
+            self.static_targets = self.get_static_targets()
+            self.static_key = static_key
+        output = []
+        get_h = time.localtime().tm_hour
+        for village, distance in self.static_targets:
+            vid = village["id"]
+            if vid in self._unknown_ignored:
+                continue
             if village["owner"] != "0":
-                get_h = time.localtime().tm_hour
                 if get_h in range(0, 8) or get_h == 23:
                     self.logger.debug(
                         "Village %s will be ignored because it is player owned and attack between 23h-8h"
                         % vid
                     )
                     continue
-            distance = self.map.get_dist(village["location"])
-            if distance > self.farm_radius:
-                if vid not in self.ignored:
-                    self.logger.debug(
-                        "Village %s will be ignored because it is too far away: distance is %f, max is %d"
-                        % (vid, distance, self.farm_radius)
-                    )
-                    self.ignored.append(vid)
-                continue
-            if vid in self.ignored:
-                self.logger.debug("Removed %s from farm ignore list" % vid)
-                self.ignored.remove(vid)
-
             output.append([village, distance])
         self.logger.info(
             "Farm targets: %d Ignored targets: %d" % (len(output), len(self.ignored))
         )
-        self.targets = sorted(output, key=lambda x: x[1])
+        # static targets are already sorted by distance
+        self.targets = output
+        self.get_travel_times()
+
+    @staticmethod
+    def template_key(template):
+        return tuple(sorted(template.items()))
+
+    def get_travel_times(self):
+        self.travel_times = {}
+        template = self.active_template or self.template
+        if not template or not self.targets:
+            return
+        templates = template if type(template) == list else [template]
+        vids = [village["id"] for village, distance in self.targets]
+        distances = [distance for village, distance in self.targets]
+        for template in templates:
+            speed = self.troopmanager.template_speed(template)
+            if not speed:
+                continue
+            times = WorldMap.travel_times(distances, speed, self.world_speed)
+            self.travel_times[self.template_key(template)] = dict(zip(vids, times))
+
+    def arrives_in_peace(self, vid, template):
+        if not self.forced_peace_time:
+            return False
+        times = self.travel_times.get(self.template_key(template))
+        if not times or vid not in times:
+            return False
+        return datetime.now() + timedelta(seconds=int(times[vid])) > self.forced_peace_time
 
     def attacked(
         self, vid, scout=False, high_profile=False, safe=True, low_profile=False
@@ -340,6 +528,70 @@ class AttackManager:
             self.attacked(vid, scout=True, safe=False)
             return True
 
+    def clear_target(self, vid):
+        """
+        Attacks a farm that has defenders with the cheapest army that kills them, based on the latest scout report
+        """
+        entry = self.repman.last_report_for(vid)
+        if not entry or "defence_units" not in entry["extra"]:
+            return False
+        if entry["extra"]["when"] + self.farm_low_prio_wait * 2 < int(time.time()):
+            # too old to trust, the village gets scouted again
+            return False
+        cache_entry = AttackCache.get_cache(vid)
+        if cache_entry and cache_entry["last_attack"] > entry["extra"]["when"]:
+            # already attacked or scouted since this report
+            return False
+        defenders = {
+            unit: amount - entry["extra"].get("defence_losses", {}).get(unit, 0)
+            for unit, amount in entry["extra"]["defence_units"].items()
+        }
+        if not any(defenders.values()):
+            return False
+        wall = entry["extra"].get("buildings", {}).get("wall", 0)
+        army = self.sim.minimal_army(
+            self.troopmanager.troops,
+            defenders,
+            wall=wall,
+            max_losses=self.clear_max_losses,
+            cost=self.clear_cost,
+        )
+        if not army:
+            self.logger.debug("%s: no army available that clears %s" % (vid, defenders))
+            return False
+        attack_result = self.attack(vid, troops=army)
+        if not attack_result or attack_result == "forced_peace":
+            return False
+        self.logger.info(
+            "Clearing %s -> %s (defenders %s, wall %d) with %s"
+            % (self.village_id, vid, str(defenders), wall, str(army))
+        )
+        self.wrapper.reporter.report(
+            self.village_id,
+            "TWB_FARM",
+            "Clearing %s -> %s (%s)" % (self.village_id, vid, str(army)),
+        )
+        for u in army:
+            self.troopmanager.troops[u] = str(int(self.troopmanager.troops[u]) - army[u])
+        self.attacked(vid, scout=True, safe=False)
+        return True
+
+    def farm_ready(self, vid):
+        """
+        False for farms that are marked unsafe or still on cooldown, used for planning only
+        """
+        cache_entry = AttackCache.get_cache(vid)
+        if not cache_entry:
+            return True
+        if not cache_entry["safe"]:
+            return False
+        min_time = self.farm_default_wait
+        if cache_entry["high_profile"]:
+            min_time = self.farm_high_prio_wait
+        if cache_entry.get("low_profile"):
+            min_time = self.farm_low_prio_wait
+        return cache_entry["last_attack"] + min_time <= int(time.time())
+
     def can_attack(self, vid, clear=False):
         cache_entry = AttackCache.get_cache(vid)
 
@@ -376,6 +628,8 @@ class AttackManager:
                     )
                     return False
                 if status == 0:
+                    if self.clear_defended and self.clear_target(vid):
+                        return False
                     if cache_entry["last_attack"] + self.farm_low_prio_wait * 2 > int(
                         time.time()
                     ):
@@ -443,6 +697,10 @@ class AttackManager:
         return True
 
     def attack(self, vid, troops=None):
+        if troops and self.loot_assistant:
+            template_id = self.la_templates.get(self.template_key(troops))
+            if template_id:
+                return self.send_loot_assistant(vid, template_id)
         url = "game.php?village=%s&screen=place&target=%s" % (self.village_id, vid)
         pre_attack = self.wrapper.get_url(url)
         pre_data = {}
@@ -502,28 +760,108 @@ class AttackManager:
 
 
 class AttackCache:
+    """
+    Attack cache kept in memory, loaded once from cache/attacks
+    Every change is appended to a write-ahead log first, changed entries are written back in batches
+    """
+
+    path = os.path.join("cache", "attacks")
+    wal_path = os.path.join("cache", "attacks.wal")
+    entries = None
+    dirty = set()
+    lock = threading.RLock()
+    flush_interval = 60
+    last_flush = 0
+
+    @staticmethod
+    def load():
+        with AttackCache.lock:
+            if AttackCache.entries is not None:
+                return
+            entries = {}
+            if os.path.exists(AttackCache.path):
+                for existing in os.listdir(AttackCache.path):
+                    if not existing.endswith(".json"):
+                        continue
+                    t_path = os.path.join(AttackCache.path, existing)
+                    with open(t_path, "r") as f:
+                        try:
+                            entries[existing.replace(".json", "")] = json.load(f)
+                        except ValueError:
+                            continue
+            AttackCache.entries = entries
+            AttackCache.last_flush = time.time()
+            AttackCache.replay()
+            atexit.register(AttackCache.flush)
+
+    @staticmethod
+    def replay():
+        # changes that did not make it to disk before the last crash
+        if not os.path.exists(AttackCache.wal_path):
+            return
+        with open(AttackCache.wal_path, "r") as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # last line can be cut off halfway
+                    continue
+                AttackCache.entries[change["id"]] = change["entry"]
+                AttackCache.dirty.add(change["id"])
+        AttackCache.flush()
+
     @staticmethod
     def get_cache(village_id):
-        t_path = os.path.join("cache", "attacks", village_id + ".json")
-        if os.path.exists(t_path):
-            with open(t_path, "r") as f:
-                return json.load(f)
-        return None
+        AttackCache.load()
+        with AttackCache.lock:
+            entry = AttackCache.entries.get(village_id)
+            return dict(entry) if entry is not None else None
 
     @staticmethod
     def set_cache(village_id, entry):
-        t_path = os.path.join("cache", "attacks", village_id + ".json")
-        with open(t_path, "w") as f:
-            return json.dump(entry, f)
+        AttackCache.load()
+        with AttackCache.lock:
+            with open(AttackCache.wal_path, "a") as f:
+                f.write(json.dumps({"id": village_id, "entry": entry}) + "\n")
+            AttackCache.entries[village_id] = dict(entry)
+            AttackCache.dirty.add(village_id)
+            if AttackCache.last_flush + AttackCache.flush_interval < time.time():
+                AttackCache.flush()
+
+    @staticmethod
+    def update(village_id, changes):
+        """
+        Applies changes to a single entry in one step, so fields written by other threads in between are kept
+        """
+        AttackCache.load()
+        with AttackCache.lock:
+            entry = AttackCache.entries.get(village_id)
+            if entry is None:
+                return None
+            entry = dict(entry)
+            entry.update(changes)
+            AttackCache.set_cache(village_id, entry)
+            return entry
+
+    @staticmethod
+    def flush():
+        with AttackCache.lock:
+            if AttackCache.entries is None:
+                return
+            if not os.path.exists(AttackCache.path):
+                os.mkdir(AttackCache.path)
+            for village_id in AttackCache.dirty:
+                t_path = os.path.join(AttackCache.path, village_id + ".json")
+                with open(t_path + ".tmp", "w") as f:
+                    json.dump(AttackCache.entries[village_id], f)
+                os.replace(t_path + ".tmp", t_path)
+            AttackCache.dirty = set()
+            if os.path.exists(AttackCache.wal_path):
+                os.remove(AttackCache.wal_path)
+            AttackCache.last_flush = time.time()
 
     @staticmethod
     def cache_grab():
-        output = {}
-        c_path = os.path.join("cache", "attacks")
-        for existing in os.listdir(c_path):
-            if not existing.endswith(".json"):
-                continue
-            t_path = os.path.join("cache", "attacks", existing)
-            with open(t_path, "r") as f:
-                output[existing.replace(".json", "")] = json.load(f)
-        return output
+        AttackCache.load()
+        with AttackCache.lock:
+            return {k: dict(v) for k, v in AttackCache.entries.items()}
@@ -0,0 +1,125 @@
+import time
+
+try:
+    import numpy
+
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+
+class ResourceEstimator:
+    """
+    Predicts the current resources of farm villages from the last scouted buildings and resources
+    Loot taken by later attacks is subtracted, production is added for the time that passed
+    """
+
+    resources = ["wood", "stone", "iron"]
+    # used when a farm was scouted without the building levels
+    default_mine_level = 1
+    default_storage_level = 1
+
+    @staticmethod
+    def production(level, world_speed=1):
+        # resources per hour of a mine, level 0 still produces a little
+        if has_numpy and type(level) is not int:
+            level = numpy.asarray(level, dtype=float)
+            return numpy.where(level > 0, 30 * 1.163118 ** (level - 1), 5) * world_speed
+        return (30 * 1.163118 ** (level - 1) if level > 0 else 5) * world_speed
+
+    @staticmethod
+    def capacity(storage, hide=0):
+        # storage capacity minus what the hiding place keeps safe
+        if has_numpy and type(storage) is not int:
+            storage = numpy.asarray(storage, dtype=float)
+            hide = numpy.asarray(hide, dtype=float)
+            hidden = numpy.where(hide > 0, 150 * 1.3335 ** (hide - 1), 0)
+            return numpy.maximum(0, 1000 * 1.2294934 ** (storage - 1) - hidden)
+        hidden = 150 * 1.3335 ** (hide - 1) if hide > 0 else 0
+        return max(0, 1000 * 1.2294934 ** (storage - 1) - hidden)
+
+    @staticmethod
+    def levels(buildings):
+        return (
+            buildings.get("storage", ResourceEstimator.default_storage_level),
+            buildings.get("hide", 0),
+            {
+                r: buildings.get(r, ResourceEstimator.default_mine_level)
+                for r in ResourceEstimator.resources
+            },
+        )
+
+    @staticmethod
+    def farm_state(reports, world_speed=1):
+        """
+        Buildings and resources of a farm after its latest report (reports oldest first)
+        None when the farm was never scouted
+        """
+        buildings = {}
+        stock = None
+        at = None
+        for entry in reports:
+            extra = entry["extra"]
+            if "when" not in extra:
+                continue
+            if "buildings" in extra:
+                buildings = extra["buildings"]
+            if "resources" in extra:
+                stock = {r: int(extra["resources"].get(r, 0)) for r in ResourceEstimator.resources}
+                at = extra["when"]
+            elif stock is not None and "loot" in extra:
+                # production up to this attack, minus what was taken
+                storage, hide, mines = ResourceEstimator.levels(buildings)
+                cap = ResourceEstimator.capacity(storage, hide)
+                hours = max(0, extra["when"] - at) / 3600
+                for r in ResourceEstimator.resources:
+                    produced = ResourceEstimator.production(mines[r], world_speed) * hours
+                    stock[r] = max(
+                        0, min(cap, stock[r] + produced) - int(extra["loot"].get(r, 0))
+                    )
+                at = extra["when"]
+        if stock is None:
+            return None
+        return {"buildings": buildings, "stock": stock, "at": at}
+
+    @staticmethod
+    def estimate(farm_reports, world_speed=1, now=None):
+        """
+        Predicted total resources for every farm in farm_reports (vid -> reports, oldest first)
+        Farms that were never scouted are left out
+        """
+        now = now or time.time()
+        states = {}
+        for vid, reports in farm_reports.items():
+            state = ResourceEstimator.farm_state(reports, world_speed)
+            if state:
+                states[vid] = state
+        if not states:
+            return {}
+        ids = list(states.keys())
+        levels = [ResourceEstimator.levels(states[vid]["buildings"]) for vid in ids]
+        hours = [max(0, now - states[vid]["at"]) / 3600 for vid in ids]
+
+        if has_numpy:
+            hours = numpy.asarray(hours, dtype=float)
+            cap = ResourceEstimator.capacity([x[0] for x in levels], [x[1] for x in levels])
+            total = numpy.zeros(len(ids))
+            for r in ResourceEstimator.resources:
+                stock = numpy.asarray([states[vid]["stock"][r] for vid in ids], dtype=float)
+                produced = ResourceEstimator.production([x[2][r] for x in levels], world_speed)
+                total += numpy.minimum(cap, stock + produced * hours)
+            return dict(zip(ids, total.tolist()))
+
+        output = {}
+        for i, vid in enumerate(ids):
+            storage, hide, mines = levels[i]
+            cap = ResourceEstimator.capacity(storage, hide)
+            output[vid] = sum(
+                min(
+                    cap,
+                    states[vid]["stock"][r]
+                    + ResourceEstimator.production(mines[r], world_speed) * hours[i],
+                )
+                for r in ResourceEstimator.resources
+            )
+        return output
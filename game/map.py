@@ -1,9 +1,203 @@
 import math
+import logging
 from core.extractors import Extractor
+from core import fastjson
 import os
 import json
 import time
 import glob
+import sqlite3
+import threading
+
+try:
+    import numpy
+
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+
+class WorldMap:
+    """
+    Process wide map shared by all villages, loaded per sector
+    Sectors are only fetched again when they are older than max_age
+    """
+
+    sector_size = 20
+    villages = {}
+    map_pos = {}
+    # sector origin (x, y) -> time the sector was loaded
+    sectors = {}
+    # grid cell (x, y) -> village ids, cells are grid_size fields wide
+    grid = {}
+    grid_size = 10
+    # bumped every time a village is added or changed
+    version = 0
+    lock = threading.RLock()
+    # village ids and their coordinates as arrays, rebuilt when the version changes
+    coordinates = None
+    coordinates_version = -1
+    loaded = False
+
+    @staticmethod
+    def sector_of(x, y):
+        size = WorldMap.sector_size
+        return x - (x % size), y - (y % size)
+
+    @staticmethod
+    def sectors_around(location, radius):
+        size = WorldMap.sector_size
+        x, y = location
+        min_x, min_y = WorldMap.sector_of(max(0, x - radius), max(0, y - radius))
+        max_x, max_y = WorldMap.sector_of(x + radius, y + radius)
+        return [
+            (sx, sy)
+            for sx in range(min_x, max_x + 1, size)
+            for sy in range(min_y, max_y + 1, size)
+        ]
+
+    @staticmethod
+    def stale_sectors(location, radius, max_age):
+        now = time.time()
+        with WorldMap.lock:
+            return [
+                sector
+                for sector in WorldMap.sectors_around(location, radius)
+                if WorldMap.sectors.get(sector, 0) + max_age < now
+            ]
+
+    @staticmethod
+    def mark(sector, at=None):
+        with WorldMap.lock:
+            WorldMap.sectors[sector] = at or time.time()
+
+    @staticmethod
+    def load(max_age):
+        """
+        Fills the map from the map store once, sectors count as loaded at the oldest update of their villages
+        Villages older than max_age are left out so their sectors are fetched again
+        """
+        with WorldMap.lock:
+            if WorldMap.loaded:
+                return 0
+            WorldMap.loaded = True
+            entries = MapCache.get_recent(max_age)
+            for entry, updated in entries:
+                WorldMap.add(entry["id"], entry)
+                sector = WorldMap.sector_of(*entry["location"])
+                WorldMap.sectors[sector] = min(
+                    WorldMap.sectors.get(sector, updated), updated
+                )
+        return len(entries)
+
+    @staticmethod
+    def cell_of(x, y):
+        return x // WorldMap.grid_size, y // WorldMap.grid_size
+
+    @staticmethod
+    def add(vid, structure):
+        with WorldMap.lock:
+            existing = WorldMap.villages.get(vid)
+            if existing == structure:
+                return
+            if existing:
+                old_cell = WorldMap.cell_of(*existing["location"])
+                if old_cell in WorldMap.grid:
+                    WorldMap.grid[old_cell].discard(vid)
+            cell = WorldMap.cell_of(*structure["location"])
+            if cell not in WorldMap.grid:
+                WorldMap.grid[cell] = set()
+            WorldMap.grid[cell].add(vid)
+            WorldMap.villages[vid] = structure
+            WorldMap.map_pos[vid] = structure["location"]
+            WorldMap.version += 1
+
+    @staticmethod
+    def get_coordinates():
+        with WorldMap.lock:
+            if WorldMap.coordinates_version != WorldMap.version:
+                ids = list(WorldMap.villages.keys())
+                locations = numpy.array(
+                    [WorldMap.villages[vid]["location"] for vid in ids], dtype=float
+                ).reshape(-1, 2)
+                WorldMap.coordinates = (ids, locations)
+                WorldMap.coordinates_version = WorldMap.version
+            return WorldMap.coordinates
+
+    @staticmethod
+    def distances(location, locations):
+        """
+        Distance from location to every entry of locations, a list or (n, 2) array of coordinates
+        """
+        if has_numpy:
+            locations = numpy.asarray(locations, dtype=float).reshape(-1, 2)
+            return numpy.hypot(locations[:, 0] - location[0], locations[:, 1] - location[1])
+        return [math.hypot(x - location[0], y - location[1]) for x, y in locations]
+
+    @staticmethod
+    def travel_times(distances, minutes_per_field, world_speed=1):
+        """
+        One way travel time in seconds for every distance
+        """
+        factor = minutes_per_field * 60 / (world_speed or 1)
+        if has_numpy:
+            return numpy.rint(numpy.asarray(distances, dtype=float) * factor)
+        return [round(distance * factor) for distance in distances]
+
+    @staticmethod
+    def within(location, radius):
+        """
+        Villages within radius of location as [village, distance], nearest first
+        """
+        if has_numpy:
+            return WorldMap.within_numpy(location, radius)
+        return WorldMap.within_grid(location, radius)
+
+    @staticmethod
+    def within_numpy(location, radius):
+        ids, locations = WorldMap.get_coordinates()
+        if not ids:
+            return []
+        distances = WorldMap.distances(location, locations)
+        found = numpy.flatnonzero(distances <= radius)
+        found = found[numpy.argsort(distances[found], kind="stable")]
+        with WorldMap.lock:
+            return [
+                [WorldMap.villages[ids[i]], float(distances[i])]
+                for i in found
+                if ids[i] in WorldMap.villages
+            ]
+
+    @staticmethod
+    def within_grid(location, radius):
+        x, y = location
+        min_x, min_y = WorldMap.cell_of(x - radius, y - radius)
+        max_x, max_y = WorldMap.cell_of(x + radius, y + radius)
+        output = []
+        with WorldMap.lock:
+            for cx in range(min_x, max_x + 1):
+                for cy in range(min_y, max_y + 1):
+                    for vid in WorldMap.grid.get((cx, cy), ()):
+                        village = WorldMap.villages[vid]
+                        distance = math.sqrt(
+                            (village["location"][0] - x) ** 2
+                            + (village["location"][1] - y) ** 2
+                        )
+                        if distance <= radius:
+                            output.append([village, distance])
+        output.sort(key=lambda item: item[1])
+        return output
+
+    @staticmethod
+    def around(location, radius):
+        x, y = location
+        with WorldMap.lock:
+            return {
+                vid: village
+                for vid, village in WorldMap.villages.items()
+                if abs(village["location"][0] - x) <= radius
+                and abs(village["location"][1] - y) <= radius
+            }
 
 
 class Map:
@@ -12,59 +206,118 @@ class Map:
     map_data = []
     villages = {}
     my_location = None
-    map_pos = {}
+    map_pos = WorldMap.map_pos
     last_fetch = 0
     fetch_delay = 8
+    radius = 50
+    # sectors per map.php request
+    sectors_per_request = 10
+    pending = {}
+    logger = logging.getLogger("Map")
 
     def __init__(self, wrapper=None, village_id=None):
         self.wrapper = wrapper
         self.village_id = village_id
 
     def get_map(self):
-        if self.last_fetch + (self.fetch_delay * 3600) > time.time():
-            return
+        self.pending = {}
+        result = True
+        if not WorldMap.loaded:
+            loaded = WorldMap.load(self.fetch_delay * 3600)
+            if loaded:
+                self.logger.info("Loaded %d villages from the map cache" % loaded)
+        if not self.my_location:
+            result = self.get_map_screen()
+        if self.my_location:
+            self.get_sectors()
+        self.store_pending()
+        self.villages = WorldMap.around(self.my_location, self.radius) if self.my_location else {}
+        return result
+
+    def get_map_screen(self):
         self.last_fetch = time.time()
         res = self.wrapper.get_action(village_id=self.village_id, action="map")
         game_state = Extractor.game_state(res)
         self.map_data = Extractor.map_data(res)
         if self.map_data:
-            for tile in self.map_data:
-                data = tile["data"]
-                x = int(data["x"])
-                y = int(data["y"])
-                vdata = data["villages"]
-                # Fix broken parsing                 
-                if type(vdata) is dict:
-                    cdata = [{}] * 20
-                    for k, v in vdata.items():
-                        if type(v) is not dict:
-                            cdata[int(k)] = {0: item[0:] for item in v}
-                        else:
-                            cdata[int(k)] = v
-                    vdata = cdata
-                for lon, val in enumerate(vdata):
-                    if not val:
-                        continue
-                    # Force dict type to iterate properly
-                    if type(val) != dict:
-                        val = {i: val[i] for i in range(0, len(val))}
-                    for lat, entry in val.items():
-                        if not lat:
-                            continue
-                        coords = [x + int(lon), y + int(lat)]
-                        if entry[0] == str(self.village_id):
-                            self.my_location = coords
-
-                        self.build_cache_entry(location=coords, entry=entry)
-                if not self.my_location:
-                    self.my_location = [
-                        game_state["village"]["x"],
-                        game_state["village"]["y"],
-                    ]
-        if not self.map_data or not self.villages:
+            self.parse_tiles(self.map_data)
+            if not self.my_location:
+                self.my_location = [
+                    game_state["village"]["x"],
+                    game_state["village"]["y"],
+                ]
+        if not self.map_data or not self.pending:
             return self.get_map_old(game_state=game_state)
         return True
 
+    def get_sectors(self):
+        stale = WorldMap.stale_sectors(
+            self.my_location, self.radius, self.fetch_delay * 3600
+        )
+        if not stale:
+            return
+        self.last_fetch = time.time()
+        urls = []
+        for i in range(0, len(stale), self.sectors_per_request):
+            chunk = stale[i : i + self.sectors_per_request]
+            urls.append(
+                "map.php?v=2&e=%d&%s"
+                % (
+                    int(time.time() * 1000),
+                    "&".join("%d_%d=1" % sector for sector in chunk),
+                )
+            )
+        for res in self.wrapper.get_urls(urls):
+            if not res:
+                continue
+            try:
+                tiles = fastjson.loads(res.text)
+            except ValueError:
+                self.logger.warning("Unable to read map sectors for village %s" % self.village_id)
+                continue
+            self.parse_tiles(tiles)
+        # sectors without any village are never part of the response
+        for sector in stale:
+            WorldMap.mark(sector)
+        self.logger.debug(
+            "Loaded %d map sectors around %s" % (len(stale), self.my_location)
+        )
+
+    def parse_tiles(self, tiles):
+        for tile in tiles:
+            data = tile["data"] if "data" in tile else tile
+            x = int(data["x"])
+            y = int(data["y"])
+            vdata = data["villages"]
+            # Fix broken parsing
+            if type(vdata) is dict:
+                cdata = [{}] * 20
+                for k, v in vdata.items():
+                    if type(v) is not dict:
+                        cdata[int(k)] = {0: item[0:] for item in v}
+                    else:
+                        cdata[int(k)] = v
+                vdata = cdata
+            for lon, val in enumerate(vdata):
+                if not val:
+                    continue
+                # Force dict type to iterate properly
+                if type(val) != dict:
+                    val = {i: val[i] for i in range(0, len(val))}
+                for lat, entry in val.items():
+                    if not lat:
+                        continue
+                    coords = [x + int(lon), y + int(lat)]
+                    if entry[0] == str(self.village_id):
+                        self.my_location = coords
+
+                    self.build_cache_entry(location=coords, entry=entry)
+            WorldMap.mark(WorldMap.sector_of(x, y))
+
+    def store_pending(self):
+        MapCache.set_many(self.pending)
+        self.pending = {}
+
     def get_map_old(self, game_state):
         if self.map_data:
             for tile in self.map_data:
@@ -88,7 +341,7 @@ class Map:
                     game_state["village"]["x"],
                     game_state["village"]["y"],
                 ]
-        if not self.map_data or not self.villages:
+        if not self.map_data or not self.pending:
             print(
                 "Error reading map state for village %s, farming might not work properly"
                 % self.village_id
@@ -116,13 +369,18 @@ class Map:
             "buildings": {},
             "resources": {},
         }
-        self.map_pos[vid] = location
-        cached = self.in_cache(vid)
-        if not cached:
-            MapCache.set_cache(village_id=vid, entry=structure)
-        if cached and cached != structure:
-            MapCache.set_cache(village_id=vid, entry=structure)
-        self.villages[vid] = structure
+        WorldMap.add(vid, structure)
+        # written to the map store in one go once the map is parsed
+        self.pending[vid] = structure
+
+    @property
+    def version(self):
+        return WorldMap.version
+
+    def within(self, radius):
+        if not self.my_location:
+            return []
+        return WorldMap.within(self.my_location, radius)
 
     def in_cache(self, vid):
         entry = MapCache.get_cache(village_id=vid)
@@ -137,26 +395,110 @@ class Map:
 
 
 class MapCache:
+    """
+    All known map villages in a single SQLite file (cache/map.db)
+    Replaces the old one json file per village layout in cache/villages, which gets imported once
+    """
+
+    path = os.path.join("cache", "map.db")
+    legacy_path = os.path.join("cache", "villages")
+    connection = None
+    lock = threading.RLock()
+
+    @staticmethod
+    def get_connection():
+        with MapCache.lock:
+            if MapCache.connection:
+                return MapCache.connection
+            con = sqlite3.connect(MapCache.path, check_same_thread=False)
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS villages ("
+                "id TEXT PRIMARY KEY, x INTEGER, y INTEGER, owner TEXT, "
+                "points INTEGER, data TEXT, updated INTEGER)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS villages_xy ON villages (x, y)")
+            con.commit()
+            MapCache.connection = con
+            MapCache.migrate()
+            return con
+
+    @staticmethod
+    def migrate():
+        con = MapCache.connection
+        if not os.path.exists(MapCache.legacy_path):
+            return
+        if con.execute("SELECT COUNT(*) FROM villages").fetchone()[0] > 0:
+            return
+        entries = {}
+        for t_path in glob.iglob(os.path.join(MapCache.legacy_path, "*.json")):
+            try:
+                with open(t_path, "r") as f:
+                    entry = json.load(f)
+                entries[entry["id"]] = entry
+            except (ValueError, KeyError):
+                continue
+        if entries:
+            MapCache.set_many(entries)
+            print("Imported %d villages from the old map cache" % len(entries))
+
+    @staticmethod
+    def row(entry):
+        return (
+            entry["id"],
+            entry["location"][0],
+            entry["location"][1],
+            entry["owner"],
+            entry["points"],
+            json.dumps(entry),
+            int(time.time()),
+        )
+
     @staticmethod
     def get_cache(village_id):
-        t_path = os.path.join("cache", "villages", village_id + ".json")
-        if os.path.exists(t_path):
-            with open(t_path, "r") as f:
-                return json.load(f)
+        con = MapCache.get_connection()
+        with MapCache.lock:
+            result = con.execute(
+                "SELECT data FROM villages WHERE id = ?", (village_id,)
+            ).fetchone()
+        if result:
+            return json.loads(result[0])
         return None
 
+    @staticmethod
+    def get_recent(max_age):
+        """
+        [entry, updated] for every village that was updated in the last max_age seconds
+        """
+        con = MapCache.get_connection()
+        with MapCache.lock:
+            return [
+                (json.loads(data), updated)
+                for data, updated in con.execute(
+                    "SELECT data, updated FROM villages WHERE updated >= ?",
+                    (int(time.time() - max_age),),
+                )
+            ]
+
     @staticmethod
     def set_cache(village_id, entry):
-        t_path = os.path.join("cache", "villages", village_id + ".json")
-        with open(t_path, "w") as f:
-            return f.write(json.dumps(entry))
+        return MapCache.set_many({village_id: entry})
 
     @staticmethod
-    def get_all_cache():
-        all_villages = []
-        # Load all villages from cache!
-        for t_path in glob.iglob("cache/villages/*.json"):
-            with open(t_path, "r") as f:
-                all_villages.append(json.load(f))
+    def set_many(entries):
+        if not entries:
+            return 0
+        con = MapCache.get_connection()
+        with MapCache.lock:
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO villages (id, x, y, owner, points, data, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [MapCache.row(entry) for entry in entries.values()],
+                )
+        return len(entries)
 
-        return all_villages
+    @staticmethod
+    def get_all_cache():
+        con = MapCache.get_connection()
+        with MapCache.lock:
+            return [json.loads(x[0]) for x in con.execute("SELECT data FROM villages")]
@@ -0,0 +1,97 @@
+import logging
+import threading
+
+from game.reports import FarmStats
+
+
+class FarmPlanner:
+    """
+    Assigns every farm target to a single own village once per cycle
+    Villages register their candidate targets and free farm slots while farming, the next plan uses them
+    Farms that can be attacked are handed out greedily by expected loot per second of travel time,
+    farms on cooldown or marked unsafe go to the closest village so only that one scouts or checks them
+    """
+
+    enabled = False
+    # expected haul for farms that were never looted
+    unknown_loot = 100
+    # village_id -> {"targets": {vid: distance}, "capacity": int, "speed": minutes per field, "blocked": set}
+    candidates = {}
+    # target vid -> village_id
+    assignments = {}
+    lock = threading.Lock()
+    logger = logging.getLogger("FarmPlanner")
+
+    @staticmethod
+    def register(village_id, targets, capacity, speed, blocked=()):
+        """
+        blocked: targets that can not be attacked this cycle (cooldown, unsafe)
+        """
+        with FarmPlanner.lock:
+            FarmPlanner.candidates[village_id] = {
+                "targets": {village["id"]: distance for village, distance in targets},
+                "capacity": capacity,
+                "speed": speed or 1,
+                "blocked": set(blocked),
+            }
+
+    @staticmethod
+    def expected_loot(stats, vid):
+        if vid in stats and stats[vid]["attacks"]:
+            return stats[vid]["average_haul"]
+        return FarmPlanner.unknown_loot
+
+    @staticmethod
+    def plan():
+        with FarmPlanner.lock:
+            candidates = dict(FarmPlanner.candidates)
+        if not candidates:
+            return {}
+        stats = FarmStats.get_all()
+        pairs = []
+        closest = {}
+        for village_id, entry in candidates.items():
+            for vid, distance in entry["targets"].items():
+                travel = max(distance * entry["speed"], 1)
+                if vid in entry["blocked"]:
+                    if vid not in closest or travel < closest[vid][0]:
+                        closest[vid] = (travel, village_id)
+                    continue
+                pairs.append((FarmPlanner.expected_loot(stats, vid) / travel, village_id, vid))
+        pairs.sort(key=lambda x: x[0], reverse=True)
+
+        capacity = {village_id: entry["capacity"] for village_id, entry in candidates.items()}
+        assignments = {}
+        for score, village_id, vid in pairs:
+            if vid in assignments or capacity[village_id] <= 0:
+                continue
+            assignments[vid] = village_id
+            capacity[village_id] -= 1
+        farmed = len(assignments)
+        # the rest goes to the village it scores best for, so every target has exactly one village
+        for score, village_id, vid in pairs:
+            if vid not in assignments:
+                assignments[vid] = village_id
+        for vid, (travel, village_id) in closest.items():
+            if vid not in assignments:
+                assignments[vid] = village_id
+        with FarmPlanner.lock:
+            FarmPlanner.assignments = assignments
+        FarmPlanner.logger.info(
+            "Assigned %d farm targets to %d villages (%d within the farm capacity)"
+            % (len(assignments), len(candidates), farmed)
+        )
+        return assignments
+
+    @staticmethod
+    def filter_targets(village_id, targets):
+        """
+        Keeps the targets assigned to this village and the ones the last plan did not know, keeps the order
+        """
+        with FarmPlanner.lock:
+            assignments = FarmPlanner.assignments
+        return [
+            target
+            for target in targets
+            if assignments.get(target[0]["id"], village_id) == village_id
+        ]
@@ -1,12 +1,115 @@
+import bisect
+import concurrent.futures
 import os
 import json
+import queue
 import re
+import sys
 import logging
+import sqlite3
+import threading
+import time
+import zlib
 
 from core.extractors import Extractor
+from core.governor import RequestGovernor
+from game.estimator import ResourceEstimator
+from game.troopmanager import TroopManager
 from datetime import datetime
 
 
+class ReportStore:
+    """
+    Process wide store of the processed reports, shared by every village
+    The newest reports are loaded once from the archive and indexed by destination village
+    """
+
+    reports = {}
+    # dest village -> ([when, ...], [report, ...]) sorted by when, reports without a time come first
+    dest_index = {}
+    loaded = False
+    # only the newest reports are kept in memory, older ones stay in the archive
+    load_limit = 10000
+    # reports added since the last flush, written to the archive in one transaction
+    pending = {}
+    pending_raw = {}
+    lock = threading.RLock()
+    logger = logging.getLogger("Reports")
+
+    @staticmethod
+    def load():
+        with ReportStore.lock:
+            if ReportStore.loaded:
+                return
+            ReportStore.logger.info("First run, re-reading cache entries")
+            ReportStore.reports = ReportCache.cache_grab(limit=ReportStore.load_limit)
+            ReportStore.dest_index = {}
+            for entry in ReportStore.reports.values():
+                ReportStore.index(entry)
+            ReportStore.loaded = True
+            ReportStore.logger.info("Got %d reports from cache" % len(ReportStore.reports))
+
+    @staticmethod
+    def index(entry):
+        dest = entry["dest"]
+        if dest is None:
+            return
+        when = int(entry["extra"]["when"]) if "when" in entry["extra"] else -1
+        if dest not in ReportStore.dest_index:
+            ReportStore.dest_index[dest] = ([], [])
+        whens, reports = ReportStore.dest_index[dest]
+        # reports with the same time stay in the order they were added
+        position = bisect.bisect_right(whens, when)
+        whens.insert(position, when)
+        reports.insert(position, entry)
+
+    @staticmethod
+    def add(report_id, entry, raw=None):
+        ReportStore.load()
+        with ReportStore.lock:
+            ReportStore.pending[report_id] = entry
+            if raw:
+                ReportStore.pending_raw[report_id] = raw
+            if report_id in ReportStore.reports:
+                return
+            ReportStore.reports[report_id] = entry
+            ReportStore.index(entry)
+
+    @staticmethod
+    def flush():
+        with ReportStore.lock:
+            pending = ReportStore.pending
+            pending_raw = ReportStore.pending_raw
+            ReportStore.pending = {}
+            ReportStore.pending_raw = {}
+        return ReportCache.set_many(pending, raw=pending_raw)
+
+    @staticmethod
+    def high_water():
+        # highest report id of which all older reports are processed
+        return int(ReportCache.get_state("high_water", 0))
+
+    @staticmethod
+    def set_high_water(report_id):
+        ReportCache.set_state("high_water", report_id)
+
+    @staticmethod
+    def has(report_id):
+        ReportStore.load()
+        return report_id in ReportStore.reports or ReportCache.has(report_id)
+
+    @staticmethod
+    def reports_for(vid):
+        """
+        Reports for destination village vid, oldest first
+        """
+        ReportStore.load()
+        with ReportStore.lock:
+            if vid not in ReportStore.dest_index:
+                return []
+            return list(ReportStore.dest_index[vid][1])
+
+
 class ReportManager:
     wrapper = None
     village_id = None
@@ -14,65 +117,106 @@ class ReportManager:
     logger = None
     trade_got_accepted = False
 
-    last_reports = {}
+    # load report bodies on a background thread instead of during the village run
+    background = False
+    worker_idle = 30
+    # processes used to parse a large batch of reports, 1 parses everything in the bot process
+    parse_workers = 1
+    # keep the report html in the archive so reports can be parsed again later
+    keep_raw = False
+    world_speed = 1
+    # predicted resources that make a farm a priority target
+    priority_loot = 2000
 
     def __init__(self, wrapper=None, village_id=None):
         self.wrapper = wrapper
         self.village_id = village_id
+        self.crawl_top = 0
+        self.crawl_failed = False
+        self.crawl_capped = False
+        self.crawling = False
+        self.backlog = queue.Queue()
+        self.queued = set()
+        self.queue_lock = threading.Lock()
+        self.worker = None
+
+    @property
+    def last_reports(self):
+        ReportStore.load()
+        return ReportStore.reports
 
     def last_report_for(self, vid):
-        possible_reports = []
-        for repid in self.last_reports:
-            entry = self.last_reports[repid]
-            if vid == entry["dest"] and "when" in entry["extra"]:
-                possible_reports.append(entry)
-        if len(possible_reports) == 0:
+        reports = ReportStore.reports_for(vid)
+        if not reports or "when" not in reports[-1]["extra"]:
             return None
+        return reports[-1]
+
+    def expected_loot(self, farms):
+        """
+        Expected haul for every farm, None when it can not be told
+        Scouted farms use the resource estimate, the others the last haul if it did not come back full
+        """
+        estimates = ResourceEstimator.estimate(
+            {target["id"]: ReportStore.reports_for(target["id"]) for target, distance in farms},
+            world_speed=self.world_speed,
+        )
+        output = {}
+        for target, distance in farms:
+            if target["id"] in estimates:
+                output[target["id"]] = estimates[target["id"]]
+                continue
+            entry = self.last_report_for(target["id"])
+            if (
+                entry
+                and "loot" in entry["extra"]
+                and "units_sent" in entry["extra"]
+                and not self.has_full_loot(entry)
+            ):
+                output[target["id"]] = sum(int(x) for x in entry["extra"]["loot"].values())
+            else:
+                output[target["id"]] = None
+        return output
 
-        def highest_when(attack):
-            return datetime.fromtimestamp(int(attack["extra"]["when"]))
-
-        # self.logger.debug(f"Reports: {possible_reports}")
-        return max(possible_reports, key=highest_when)
-
-    def priority_farms(self, farms):
+    def priority_farms(self, farms, speed=1):
+        """
+        Farms expected to hold more than priority_loot resources, best predicted haul per minute of travel first
+        speed is the minutes per field of the farm template
+        """
+        estimates = ResourceEstimator.estimate(
+            {target["id"]: ReportStore.reports_for(target["id"]) for target, distance in farms},
+            world_speed=self.world_speed,
+        )
         priority = []
         for farm in farms:
             target, distance = farm
-            has_res, res = self.has_resources_left(target["id"])
-            if has_res:
-                total_loot = 0
-                for x in res:
-                    total_loot += int(res[x])
-                if total_loot > 2000:
+            if target["id"] in estimates:
+                predicted = estimates[target["id"]]
+                if predicted > self.priority_loot:
                     # Found priority farm!!!
                     self.logger.debug(
-                        f"Found priority farm!! Total loot: {total_loot} Distance: {distance}"
-                    )
-                    priority.append(farm)
-                if "unknown" in res:
-                    self.logger.debug(
-                        f"Last attack had no scout, but returned full! Distance: {distance}"
+                        f"Found priority farm!! Predicted loot: {int(predicted)} Distance: {distance}"
                     )
                     priority.append(farm)
+                continue
+            has_res, res = self.has_resources_left(target["id"])
+            if has_res and "unknown" in res:
+                self.logger.debug(
+                    f"Last attack had no scout, but returned full! Distance: {distance}"
+                )
+                priority.append(farm)
+
+        def haul_per_minute(farm):
+            target, distance = farm
+            predicted = estimates.get(target["id"], self.priority_loot)
+            return predicted / max(1, distance * speed)
 
-        return priority
+        return sorted(priority, key=haul_per_minute, reverse=True)
 
     def has_resources_left(self, vid):
-        possible_reports = []
-        for repid in self.last_reports:
-            entry = self.last_reports[repid]
-            if vid == entry["dest"] and "when" in entry["extra"]:
-                possible_reports.append(entry)
-        # self.logger.debug(f"Considered {len(possible_reports)} reports")
-        if len(possible_reports) == 0:
+        entry = self.last_report_for(vid)
+        if not entry:
             return False, {}
 
-        def highest_when(attack):
-            return datetime.fromtimestamp(int(attack["extra"]["when"]))
-
-        # self.logger.debug(f"Reports: {possible_reports}")
-        entry = max(possible_reports, key=highest_when)
         if "spy" in entry["extra"]["units_sent"]:
             if "resources" in entry["extra"] and entry["extra"]["resources"] != {}:
                 return True, entry["extra"]["resources"]
@@ -85,24 +229,12 @@ class ReportManager:
         units_sent = entry["extra"]["units_sent"]
         units_losses = entry["extra"]["units_losses"]
         loot = entry["extra"]["loot"]
-        carry = [
-            "spear:25",
-            "sword:15",
-            "axe:10",
-            "spy:0",
-            "archer:10",
-            "light:80",
-            "marcher:50",
-            "heavy:50",
-            "knight:100",
-        ]
         total_loot = 0
         for x in loot:
             total_loot += int(loot[x])
 
         total_carry = 0
-        for unit in carry:
-            item, carry = unit.split(":")
+        for item, carry in TroopManager.unit_carry.items():
             if item in units_sent:
                 returning = units_sent[item]
                 if item in units_losses:
@@ -116,94 +248,269 @@ class ReportManager:
         return total_carry == total_loot
 
     def safe_to_engage(self, vid):
-        for repid in self.last_reports:
-            entry = self.last_reports[repid]
-            if vid == entry["dest"]:
-                if entry["type"] == "attack" and entry["losses"] == {}:
-                    return 1
-                if (
-                    entry["type"] == "scout"
-                    and entry["losses"] == {}
-                    and (
-                        entry["extra"]["defence_units"] == {}
-                        or entry["extra"]["defence_units"]
-                        == entry["extra"]["defence_losses"]
-                    )
-                ):
-                    return 1
-
-                if entry["losses"] != {}:
-                    # Acceptable losses for attacks
-                    print(f'Units sent: {entry["extra"]["units_sent"]}')
-                    print(f'Units lost: {entry["losses"]}')
-
-                for sent_type in entry["extra"]["units_sent"]:
-                    amount = entry["extra"]["units_sent"][sent_type]
-                    if sent_type in entry["losses"]:
-                        if amount == entry["losses"][sent_type]:
-                            return 0  # Lost all units!
-                        elif entry["losses"][sent_type] <= 1:
-                            # Allow to lose 1 unit (luck depended)
-                            return 1  # Lost 'just' one unit
-
-                if entry["losses"] != {}:
-                    return 0  # Disengage if anything was lost!
+        # newest report decides
+        for entry in reversed(ReportStore.reports_for(vid)):
+            if entry["type"] == "attack" and entry["losses"] == {}:
+                return 1
+            if (
+                entry["type"] == "scout"
+                and entry["losses"] == {}
+                and (
+                    entry["extra"]["defence_units"] == {}
+                    or entry["extra"]["defence_units"]
+                    == entry["extra"]["defence_losses"]
+                )
+            ):
+                return 1
+
+            if entry["losses"] != {}:
+                # Acceptable losses for attacks
+                print(f'Units sent: {entry["extra"]["units_sent"]}')
+                print(f'Units lost: {entry["losses"]}')
+
+            for sent_type in entry["extra"]["units_sent"]:
+                amount = entry["extra"]["units_sent"][sent_type]
+                if sent_type in entry["losses"]:
+                    if amount == entry["losses"][sent_type]:
+                        return 0  # Lost all units!
+                    elif entry["losses"][sent_type] <= 1:
+                        # Allow to lose 1 unit (luck depended)
+                        return 1  # Lost 'just' one unit
+
+            if entry["losses"] != {}:
+                return 0  # Disengage if anything was lost!
         return -1
 
+    def report_url(self, report_id):
+        return "game.php?village=%s&screen=report&mode=all&group_id=0&view=%s" % (
+            self.village_id,
+            report_id,
+        )
+
     def read(self, page=0, full_run=False):
+        """
+        Walks the report list from the newest report down to the first report that is already known
+        or below the high water mark, the unseen report bodies are loaded right away or queued
+        """
         if not self.logger:
             self.logger = logging.getLogger("Reports")
-        self.trade_got_accepted = False
+        if page == 0:
+            self.trade_got_accepted = False
+            self.crawl_top = 0
+            self.crawling = True
+        high_water = ReportStore.high_water()
 
-        if len(self.last_reports) == 0:
-            self.logger.info("First run, re-reading cache entries")
-            self.last_reports = ReportCache.cache_grab()
-            self.logger.info("Got %d reports from cache" % len(self.last_reports))
+        ReportStore.load()
         url = "game.php?village=%s&screen=report&mode=all&from=%d" % (
             self.village_id,
             page * 12,
         )
-        result = self.wrapper.get_url(url)
+        result = self.wrapper.get_url(url, priority=RequestGovernor.BACKGROUND)
         self.game_state = Extractor.game_state(result)
-        new = 0
-
-        ids = Extractor.report_table(result)
-        for report_id in ids:
-            if report_id in self.last_reports:
-                continue
-            new += 1
-            url = "game.php?village=%s&screen=report&mode=all&group_id=0&view=%s" % (
-                self.village_id,
-                report_id,
+        if page == 0 and self.game_state:
+            # needed to parse the stored reports again without logging in
+            ReportCache.set_state("player_id", self.player_id())
+        listed = Extractor.report_table(result)
+        reached_known = False
+        ids = []
+        for report_id in listed:
+            self.crawl_top = max(self.crawl_top, int(report_id))
+            if int(report_id) <= high_water or ReportStore.has(report_id):
+                reached_known = True
+                break
+            if report_id not in self.queued:
+                ids.append(report_id)
+
+        if self.background:
+            self.queue_reports(ids)
+        else:
+            # report pages do not depend on each other, so they can be loaded side by side
+            pages = self.wrapper.get_urls(
+                [self.report_url(report_id) for report_id in ids],
+                priority=RequestGovernor.BACKGROUND,
             )
-            data = self.wrapper.get_url(url)
+            if not self.process_reports(ids, pages):
+                self.crawl_failed = True
 
-            get_type = re.search(r'class="report_(\w+)', data.text)
-            if get_type:
-                report_type = get_type.group(1)
-                if report_type == "ReportAttack":
-                    self.attack_report(data.text, report_id)
-                    continue
-                else:
-                    if report_type == "ReportAccept":
-                        players = re.findall(r'data-player="(\d+)"', data.text)
-                        seller = players[0]
-                        buyer = players[1]
-                        if buyer == self.game_state["player"]["id"]:
-                            self.logger.debug("We bought something on the market")
-                        elif seller == self.game_state["player"]["id"]:
-                            self.logger.debug("We sold something on the market")
-                            self.trade_got_accepted = True
-                    res = self.put(report_id, report_type=report_type)
-                    self.last_reports[report_id] = res
-        if new == 12 or full_run and page < 20:
+        if len(listed) == 12 and not reached_known and page < 20:
             page += 1
             self.logger.debug(
-                "%d new reports where added, also checking page %d" % (new, page)
+                "%d new reports where added, also checking page %d" % (len(ids), page)
             )
             return self.read(page, full_run=full_run)
+        if len(listed) == 12 and not reached_known:
+            # stopped at the page limit, older unseen reports are left below the old mark
+            self.logger.debug("Stopped at report page %d before reaching known reports" % page)
+            self.crawl_capped = True
+        with self.queue_lock:
+            self.crawling = False
+            # with the background lane the last report body finishes the crawl
+            if not self.queued:
+                self.crawl_done()
+
+    def crawl_done(self):
+        # the mark only moves when everything down to the old mark was read
+        if (
+            not self.crawl_failed
+            and not self.crawl_capped
+            and self.crawl_top > ReportStore.high_water()
+        ):
+            ReportStore.set_high_water(self.crawl_top)
+        self.crawl_failed = False
+        self.crawl_capped = False
+
+    def queue_reports(self, ids):
+        with self.queue_lock:
+            for report_id in ids:
+                self.queued.add(report_id)
+                self.backlog.put(report_id)
+            if not self.worker or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.fetch_backlog, daemon=True)
+                self.worker.start()
+
+    def fetch_backlog(self):
+        # background lane, report bodies are loaded with the lowest priority
+        while True:
+            try:
+                report_id = self.backlog.get(timeout=self.worker_idle)
+            except queue.Empty:
+                return
+            data = self.wrapper.get_url(
+                self.report_url(report_id), priority=RequestGovernor.BACKGROUND
+            )
+            if not self.process_report(report_id, data):
+                self.crawl_failed = True
+            with self.queue_lock:
+                self.queued.discard(report_id)
+                if not self.queued:
+                    ReportStore.flush()
+                    if not self.crawling:
+                        self.crawl_done()
+
+    def process_report(self, report_id, data):
+        if not data:
+            return False
+        self.merge(ReportParser.parse(report_id, data.text, self.player_id()), data.text)
+        return True
+
+    def process_reports(self, ids, pages):
+        items = [(report_id, data.text) for report_id, data in zip(ids, pages) if data]
+        results = ReportParser.parse_all(items, self.player_id(), workers=self.parse_workers)
+        for result, item in zip(results, items):
+            self.merge(result, item[1])
+        ReportStore.flush()
+        return len(items) == len(ids)
+
+    def player_id(self):
+        if self.game_state:
+            return self.game_state["player"]["id"]
+        return ReportCache.get_state("player_id")
+
+    def reparse(self):
+        """
+        Parses all stored report html again, after a parser fix, without loading anything from the game
+        """
+        if not self.logger:
+            self.logger = logging.getLogger("Reports")
+        total = 0
+        for items in ReportCache.raw_grab():
+            results = ReportParser.parse_all(items, self.player_id(), workers=self.parse_workers)
+            ReportCache.set_many({report_id: entry for report_id, entry, trade in results if entry})
+            total += len(items)
+        # reload the updated reports on next use
+        with ReportStore.lock:
+            ReportStore.loaded = False
+        self.logger.info("Parsed %d stored reports again" % total)
+        return total
+
+    def merge(self, result, text=None):
+        report_id, entry, trade = result
+        if not entry:
+            return
+        if trade == "bought":
+            self.logger.debug("We bought something on the market")
+        elif trade == "sold":
+            self.logger.debug("We sold something on the market")
+            self.trade_got_accepted = True
+        if "loot" in entry["extra"]:
+            self.logger.info("attack report %s -> %s" % (entry["origin"], entry["dest"]))
+        if "resources" in entry["extra"]:
+            self.logger.info("scout report %s -> %s" % (entry["origin"], entry["dest"]))
+        ReportStore.add(report_id, entry, raw=text if self.keep_raw else None)
+        self.logger.info(
+            "Processed %s report with id %s" % (entry["type"], str(report_id))
+        )
+
+
+class ReportParser:
+    """
+    Report parsing without any state, so report bodies can be parsed in a worker process
+    """
+
+    pool = None
+    pool_workers = 0
+    # smaller batches are parsed right away, starting the workers would take longer
+    pool_min = 8
+
+    @staticmethod
+    def parse(report_id, text, player_id):
+        """
+        Returns report_id, the report entry (or None for unknown pages) and the trade side (bought / sold) if any
+        """
+        get_type = re.search(r'class="report_(\w+)', text)
+        if not get_type:
+            return report_id, None, None
+        report_type = get_type.group(1)
+        if report_type == "ReportAttack":
+            return report_id, ReportParser.attack_report(text, player_id), None
+        trade = None
+        if report_type == "ReportAccept":
+            players = re.findall(r'data-player="(\d+)"', text)
+            seller = players[0]
+            buyer = players[1]
+            if buyer == player_id:
+                trade = "bought"
+            elif seller == player_id:
+                trade = "sold"
+        entry = {
+            "type": report_type,
+            "origin": None,
+            "dest": None,
+            "losses": {},
+            "extra": {},
+        }
+        return report_id, entry, trade
 
-    def re_unit(self, inp):
+    @staticmethod
+    def parse_all(items, player_id, workers=1):
+        """
+        Parses (report_id, text) items, in a process pool when there are enough of them
+        Results are returned in the same order as the items
+        """
+        if workers > 1 and len(items) >= ReportParser.pool_min:
+            pool = ReportParser.get_pool(workers)
+            return list(
+                pool.map(
+                    ReportParser.parse,
+                    [report_id for report_id, text in items],
+                    [text for report_id, text in items],
+                    [player_id] * len(items),
+                    chunksize=max(1, len(items) // (workers * 4)),
+                )
+            )
+        return [ReportParser.parse(report_id, text, player_id) for report_id, text in items]
+
+    @staticmethod
+    def get_pool(workers):
+        if not ReportParser.pool or ReportParser.pool_workers != workers:
+            if ReportParser.pool:
+                ReportParser.pool.shutdown()
+            ReportParser.pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            ReportParser.pool_workers = workers
+        return ReportParser.pool
+
+    @staticmethod
+    def re_unit(inp):
         output = {}
         for row in inp:
             k, v = row
@@ -211,7 +518,8 @@ class ReportManager:
                 output[k] = int(v)
         return output
 
-    def re_building(self, inp):
+    @staticmethod
+    def re_building(inp):
         output = {}
         for row in inp:
             k = row["id"]
@@ -220,7 +528,8 @@ class ReportManager:
                 output[k] = int(v)
         return output
 
-    def attack_report(self, report, report_id):
+    @staticmethod
+    def attack_report(report, player_id):
         from_village = None
         from_player = None
 
@@ -254,14 +563,14 @@ class ReportManager:
                 )
                 if units:
                     sent_units = re.findall("(?s)<tr>(.+?)</tr>", units.group(1))
-                    extra["units_sent"] = self.re_unit(
+                    extra["units_sent"] = ReportParser.re_unit(
                         Extractor.units_in_total(sent_units[0])
                     )
                     if len(sent_units) == 2:
-                        extra["units_losses"] = self.re_unit(
+                        extra["units_losses"] = ReportParser.re_unit(
                             Extractor.units_in_total(sent_units[1])
                         )
-                        if from_player == self.game_state["player"]["id"]:
+                        if from_player == player_id:
                             losses = extra["units_losses"]
 
         defender = re.search(r'(?s)(<table id="attack_info_def".+?</table>)', report)
@@ -278,14 +587,14 @@ class ReportManager:
                 )
                 if units:
                     def_units = re.findall("(?s)<tr>(.+?)</tr>", units.group(1))
-                    extra["defence_units"] = self.re_unit(
+                    extra["defence_units"] = ReportParser.re_unit(
                         Extractor.units_in_total(def_units[0])
                     )
                     if len(def_units) == 2:
-                        extra["defence_losses"] = self.re_unit(
+                        extra["defence_losses"] = ReportParser.re_unit(
                             Extractor.units_in_total(def_units[1])
                         )
-                        if to_player == self.game_state["player"]["id"]:
+                        if to_player == player_id:
                             losses = extra["defence_losses"]
         results = re.search(r'(?s)(<table id="attack_results".+?</table>)', report)
         report = report.replace('<span class="grey">.</span>', "")
@@ -296,20 +605,18 @@ class ReportManager:
             ):
                 loot[loot_entry[0]] = loot_entry[1]
             extra["loot"] = loot
-            self.logger.info("attack report %s -> %s" % (from_village, to_village))
 
         scout_results = re.search(
             r'(?s)(<table id="attack_spy_resources".+?</table>)', report
         )
         if scout_results:
-            self.logger.info("scout report %s -> %s" % (from_village, to_village))
             scout_buildings = re.search(
                 r'(?s)<input id="attack_spy_building_data" type="hidden" value="(.+?)"',
                 report,
             )
             if scout_buildings:
                 raw = scout_buildings.group(1).replace("&quot;", '"')
-                extra["buildings"] = self.re_building(json.loads(raw))
+                extra["buildings"] = ReportParser.re_building(json.loads(raw))
             found_res = {}
             for loot_entry in re.findall(
                 r'<span class="icon header (wood|stone|iron)".+?</span>(\d+)',
@@ -321,62 +628,350 @@ class ReportManager:
                 r'(?s)(<table id="attack_spy_away".+?</table>)', report
             )
             if units_away:
-                data_away = self.re_unit(Extractor.units_in_total(units_away.group(1)))
+                data_away = ReportParser.re_unit(Extractor.units_in_total(units_away.group(1)))
                 extra["units_away"] = data_away
 
         attack_type = "scout" if scout_results and not results else "attack"
-        res = self.put(
-            report_id, attack_type, from_village, to_village, data=extra, losses=losses
-        )
-        self.last_reports[report_id] = res
-        return True
-
-    def put(
-        self,
-        report_id,
-        report_type,
-        origin_village=None,
-        dest_village=None,
-        losses={},
-        data={},
-    ):
-        output = {
-            "type": report_type,
-            "origin": origin_village,
-            "dest": dest_village,
+        return {
+            "type": attack_type,
+            "origin": from_village,
+            "dest": to_village,
             "losses": losses,
-            "extra": data,
+            "extra": extra,
         }
-        ReportCache.set_cache(report_id, output)
-        self.logger.info(
-            "Processed %s report with id %s" % (report_type, str(report_id))
-        )
-        return output
+
 
 
 class ReportCache:
+    """
+    Report archive in a single SQLite file (cache/reports.db)
+    The extra data is stored as compressed json, old cache/reports/*.json files are imported once
+    """
+
+    path = os.path.join("cache", "reports.db")
+    legacy_path = os.path.join("cache", "reports")
+    connection = None
+    lock = threading.RLock()
+
+    @staticmethod
+    def get_connection():
+        with ReportCache.lock:
+            if ReportCache.connection:
+                return ReportCache.connection
+            con = sqlite3.connect(ReportCache.path, check_same_thread=False)
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS reports ("
+                "id TEXT PRIMARY KEY, type TEXT, origin TEXT, dest TEXT, "
+                "\"when\" INTEGER, losses TEXT, extra BLOB, added INTEGER)"
+            )
+            for column in ["dest", "origin", "type", "when"]:
+                con.execute(
+                    'CREATE INDEX IF NOT EXISTS reports_%s ON reports ("%s")'
+                    % (column, column)
+                )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            con.execute("CREATE TABLE IF NOT EXISTS raw (id TEXT PRIMARY KEY, body BLOB)")
+            FarmStats.create(con)
+            con.commit()
+            ReportCache.connection = con
+            ReportCache.migrate()
+            FarmStats.migrate(con)
+            return con
+
+    @staticmethod
+    def migrate():
+        con = ReportCache.connection
+        if not os.path.exists(ReportCache.legacy_path):
+            return
+        if con.execute("SELECT COUNT(*) FROM reports").fetchone()[0] > 0:
+            return
+        entries = {}
+        for existing in os.listdir(ReportCache.legacy_path):
+            if not existing.endswith(".json"):
+                continue
+            with open(os.path.join(ReportCache.legacy_path, existing), "r") as f:
+                try:
+                    entries[existing.replace(".json", "")] = json.load(f)
+                except ValueError:
+                    continue
+        if entries:
+            ReportCache.set_many(entries)
+            print("Imported %d reports from the old report cache" % len(entries))
+
+    @staticmethod
+    def row(report_id, entry):
+        return (
+            report_id,
+            entry["type"],
+            entry["origin"],
+            entry["dest"],
+            entry["extra"].get("when"),
+            json.dumps(entry["losses"]),
+            zlib.compress(json.dumps(entry["extra"]).encode()),
+            int(time.time()),
+        )
+
+    @staticmethod
+    def entry(row):
+        report_type, origin, dest, losses, extra = row
+        return {
+            "type": report_type,
+            "origin": origin,
+            "dest": dest,
+            "losses": json.loads(losses),
+            "extra": json.loads(zlib.decompress(extra)),
+        }
+
     @staticmethod
     def get_cache(report_id):
-        t_path = os.path.join("cache", "reports", report_id + ".json")
-        if os.path.exists(t_path):
-            with open(t_path, "r") as f:
-                return json.load(f)
-        return None
+        con = ReportCache.get_connection()
+        with ReportCache.lock:
+            result = con.execute(
+                "SELECT type, origin, dest, losses, extra FROM reports WHERE id = ?",
+                (report_id,),
+            ).fetchone()
+        return ReportCache.entry(result) if result else None
+
+    @staticmethod
+    def has(report_id):
+        con = ReportCache.get_connection()
+        with ReportCache.lock:
+            return (
+                con.execute("SELECT 1 FROM reports WHERE id = ?", (report_id,)).fetchone()
+                is not None
+            )
 
     @staticmethod
     def set_cache(report_id, entry):
-        t_path = os.path.join("cache", "reports", report_id + ".json")
-        with open(t_path, "w") as f:
-            return json.dump(entry, f)
+        return ReportCache.set_many({report_id: entry})
 
     @staticmethod
-    def cache_grab():
-        output = {}
-        c_path = os.path.join("cache", "reports")
-        for existing in os.listdir(c_path):
-            if not existing.endswith(".json"):
+    def get_state(key, default=None):
+        con = ReportCache.get_connection()
+        with ReportCache.lock:
+            result = con.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return result[0] if result else default
+
+    @staticmethod
+    def set_state(key, value):
+        con = ReportCache.get_connection()
+        with ReportCache.lock:
+            with con:
+                con.execute(
+                    "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                    (key, str(value)),
+                )
+
+    @staticmethod
+    def set_many(entries, raw=None):
+        if not entries:
+            return 0
+        con = ReportCache.get_connection()
+        with ReportCache.lock:
+            with con:
+                # parsing a report again must not count it twice
+                known = set()
+                ids = list(entries.keys())
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i : i + 500]
+                    known.update(
+                        x[0]
+                        for x in con.execute(
+                            "SELECT id FROM reports WHERE id IN (%s)"
+                            % ",".join("?" * len(chunk)),
+                            chunk,
+                        )
+                    )
+                FarmStats.add(con, [v for k, v in entries.items() if k not in known])
+                con.executemany(
+                    "INSERT OR REPLACE INTO reports "
+                    '(id, type, origin, dest, "when", losses, extra, added) '
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [ReportCache.row(k, v) for k, v in entries.items()],
+                )
+                if raw:
+                    con.executemany(
+                        "INSERT OR REPLACE INTO raw (id, body) VALUES (?, ?)",
+                        [(k, zlib.compress(v.encode())) for k, v in raw.items()],
+                    )
+        return len(entries)
+
+    @staticmethod
+    def raw_grab(batch=500):
+        """
+        Yields lists of (report_id, html) for every report that has its html stored
+        """
+        con = ReportCache.get_connection()
+        last = -1
+        while True:
+            with ReportCache.lock:
+                rows = con.execute(
+                    "SELECT id, body FROM raw WHERE CAST(id AS INTEGER) > ? "
+                    "ORDER BY CAST(id AS INTEGER) LIMIT ?",
+                    (last, batch),
+                ).fetchall()
+            if not rows:
+                return
+            last = int(rows[-1][0])
+            yield [(report_id, zlib.decompress(body).decode()) for report_id, body in rows]
+
+    @staticmethod
+    def cache_grab(limit=None):
+        """
+        Newest reports (by report id) as a dict report_id -> report, all of them without a limit
+        """
+        con = ReportCache.get_connection()
+        query = (
+            "SELECT id, type, origin, dest, losses, extra FROM reports "
+            "ORDER BY CAST(id AS INTEGER) DESC"
+        )
+        params = ()
+        if limit:
+            query += " LIMIT ?"
+            params = (limit,)
+        with ReportCache.lock:
+            rows = con.execute(query, params).fetchall()
+        # oldest first, the same order the reports were added in
+        return {row[0]: ReportCache.entry(row[1:]) for row in reversed(rows)}
+
+    @staticmethod
+    def prune(keep):
+        """
+        Removes everything but the newest keep reports
+        """
+        con = ReportCache.get_connection()
+        with ReportCache.lock:
+            with con:
+                removed = con.execute(
+                    "DELETE FROM reports WHERE id NOT IN "
+                    "(SELECT id FROM reports ORDER BY CAST(id AS INTEGER) DESC LIMIT ?)",
+                    (keep,),
+                ).rowcount
+                con.execute("DELETE FROM raw WHERE id NOT IN (SELECT id FROM reports)")
+        return removed
+
+
+class FarmStats:
+    """
+    Per farm totals, updated when reports are archived so they stay correct after old reports are pruned
+    """
+
+    columns = [
+        "attacks",
+        "wood",
+        "stone",
+        "iron",
+        "units_sent",
+        "units_lost",
+        "last_when",
+        "last_haul",
+        "last_loss",
+    ]
+
+    @staticmethod
+    def create(con):
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS farm_stats (dest TEXT PRIMARY KEY, %s)"
+            % ", ".join("%s INTEGER DEFAULT 0" % column for column in FarmStats.columns)
+        )
+
+    @staticmethod
+    def migrate(con):
+        # archives from before the farm stats existed
+        if con.execute("SELECT COUNT(*) FROM farm_stats").fetchone()[0] > 0:
+            return
+        if con.execute("SELECT COUNT(*) FROM reports").fetchone()[0] == 0:
+            return
+        entries = [
+            ReportCache.entry(row)
+            for row in con.execute(
+                "SELECT type, origin, dest, losses, extra FROM reports WHERE dest IS NOT NULL"
+            )
+        ]
+        with con:
+            FarmStats.add(con, entries)
+
+    @staticmethod
+    def loss_weight(losses):
+        # light cavalry counts double
+        return sum(amount * 2 if unit == "light" else amount for unit, amount in losses.items())
+
+    @staticmethod
+    def add(con, entries):
+        totals = {}
+        for entry in entries:
+            if not entry["dest"] or entry["type"] not in ["attack", "scout"]:
                 continue
-            t_path = os.path.join("cache", "reports", existing)
-            with open(t_path, "r") as f:
-                output[existing.replace(".json", "")] = json.load(f)
+            dest = entry["dest"]
+            if dest not in totals:
+                totals[dest] = dict.fromkeys(FarmStats.columns, 0)
+                totals[dest]["last_when"] = -1
+            stats = totals[dest]
+            extra = entry["extra"]
+            if entry["type"] == "attack":
+                stats["units_sent"] += sum(extra.get("units_sent", {}).values())
+                stats["units_lost"] += sum(entry["losses"].values())
+                if "loot" in extra:
+                    stats["attacks"] += 1
+                    for resource in ["wood", "stone", "iron"]:
+                        stats[resource] += int(extra["loot"].get(resource, 0))
+            when = int(extra.get("when", 0))
+            if when >= stats["last_when"]:
+                stats["last_when"] = when
+                stats["last_haul"] = sum(int(x) for x in extra.get("loot", {}).values())
+                stats["last_loss"] = FarmStats.loss_weight(entry["losses"])
+        if not totals:
+            return
+        summed = [column for column in FarmStats.columns if not column.startswith("last_")]
+        latest = [column for column in FarmStats.columns if column.startswith("last_")]
+        con.executemany(
+            "INSERT INTO farm_stats (dest, %s) VALUES (?, %s) ON CONFLICT(dest) DO UPDATE SET %s, %s"
+            % (
+                ", ".join(FarmStats.columns),
+                ", ".join("?" * len(FarmStats.columns)),
+                ", ".join("%s = %s + excluded.%s" % (c, c, c) for c in summed),
+                ", ".join(
+                    "%s = CASE WHEN excluded.last_when >= last_when THEN excluded.%s ELSE %s END"
+                    % (c, c, c)
+                    for c in latest
+                ),
+            ),
+            [
+                [dest] + [stats[column] for column in FarmStats.columns]
+                for dest, stats in totals.items()
+            ],
+        )
+
+    @staticmethod
+    def get_all():
+        con = ReportCache.get_connection()
+        output = {}
+        with ReportCache.lock:
+            for row in con.execute(
+                "SELECT dest, %s FROM farm_stats" % ", ".join(FarmStats.columns)
+            ):
+                stats = dict(zip(FarmStats.columns, row[1:]))
+                stats["loot"] = {
+                    "wood": stats["wood"],
+                    "stone": stats["stone"],
+                    "iron": stats["iron"],
+                }
+                stats["total_loot"] = stats["wood"] + stats["stone"] + stats["iron"]
+                stats["average_haul"] = (
+                    stats["total_loot"] / stats["attacks"] if stats["attacks"] else 0
+                )
+                stats["percentage_lost"] = (
+                    stats["units_lost"] / stats["units_sent"] * 100
+                    if stats["units_sent"]
+                    else 0
+                )
+                output[row[0]] = stats
         return output
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    manager = ReportManager()
+    manager.parse_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    manager.reparse()
@@ -1,6 +1,15 @@
 import math
 import os
 import json
+import random
+import sys
+
+try:
+    import numpy
+
+    has_numpy = True
+except ImportError:
+    has_numpy = False
 
 
 # Tribalwars simulator class, based on real math stuff I guess
@@ -318,29 +327,19 @@ class Simulator:
         luck = 1 + luck / 100
         nightbonus = 2 if nightbonus else 1
 
-        for item in self.pool:
-            if item not in attackerUnits:
-                attackerUnits[item] = 0
-            if item not in defenderUnits:
-                defenderUnits[item] = 0
+        # work on copies, the caller keeps its units
+        attackerUnits = {unit: attackerUnits.get(unit, 0) for unit in self.pool}
+        defenderUnits = {unit: defenderUnits.get(unit, 0) for unit in self.pool}
 
         attacker = {
-            "quantity": {},
+            "quantity": dict(attackerUnits),
             "losses": {},
         }
         defender = {
-            "quantity": {},
+            "quantity": dict(defenderUnits),
             "losses": {},
         }
 
-        for unit in self.pool:
-            attacker["quantity"][unit] = (
-                attackerUnits[unit] if unit in attackerUnits else 0
-            )
-            defender["quantity"][unit] = (
-                defenderUnits[unit] if unit in defenderUnits else 0
-            )
-
         resultingWall = self.pre_wall(wall=wall, num_rams=attackerUnits["ram"])
         wallBonus = 1 + resultingWall * 0.05
         wallDefense = 0
@@ -349,15 +348,10 @@ class Simulator:
         while self.get_sum(attackerUnits) >= 1 and self.get_sum(defenderUnits) >= 1:
             attack_strength = self.attack_sum(attackerUnits)
             def_strength = self.defense_sum(defenderUnits)
-            attack_sum = self.get_sum(attackerUnits)
 
             attackFood = self.attack_sum_food(attackerUnits)
             attackFoodSum = self.get_sum(attackFood)
-            print(attackFood, attackFoodSum)
-            defenderUnitsCopy = dict()
-
-            for unit in defenderUnits:
-                defenderUnitsCopy[unit] = defenderUnits[unit]
+            defenderUnitsCopy = dict(defenderUnits)
 
             for attackType in attack_strength:
                 if attack_strength[attackType] == 0:
@@ -376,15 +370,13 @@ class Simulator:
                     c = math.sqrt(a) * a
                     for unit in defenderUnits:
                         defenderUnits[unit] -= defenderUnitsCopy[unit] * c * ratio
-                    for i in self.attack_units[attackType]:
-                        unit = self.attack_units[attackType][i]
+                    for unit in self.attack_units[attackType]:
                         attackerUnits[unit] = 0
                 else:
                     c = math.sqrt(1 / a) / a
                     for unit in defenderUnits:
                         defenderUnits[unit] -= ratio * defenderUnitsCopy[unit]
-                    for i in self.attack_units[attackType]:
-                        unit = i
+                    for unit in self.attack_units[attackType]:
                         attackerUnits[unit] -= c * attackerUnits[unit]
 
         for unit in self.pool:
@@ -403,6 +395,293 @@ class Simulator:
             "wall_after": self.post_wall(attacker, defender, wall),
         }
 
+    def unit_arrays(self):
+        """
+        Unit stats as arrays in pool order, built on every call because update_with_real_levels changes the pool
+        """
+        units = list(self.pool)
+        types = list(self.attack_units)
+        stats = {
+            key: numpy.asarray([self.pool[unit][key] for unit in units], dtype=float)
+            for key in ["attack", "food", "def_inf", "def_kav", "def_arc"]
+        }
+        # unit -> column of its attack type
+        stats["type"] = numpy.asarray(
+            [types.index(self.attack_pool[unit]) for unit in units]
+        )
+        return units, stats
+
+    def simulate_arrays(
+        self, attackers, defenders, wall=0, nightbonus=False, moral=100, luck=0
+    ):
+        """
+        simulate for many scenarios at once
+        attackers and defenders are (scenarios, units) arrays in pool order
+        wall, nightbonus, moral and luck are a single value or one value per scenario
+        Returns the attacking and defending units left (unrounded), the wall during and after the battle
+        """
+        units, stats = self.unit_arrays()
+        attackers = numpy.array(attackers, dtype=float, ndmin=2)
+        defenders = numpy.array(defenders, dtype=float, ndmin=2)
+        quantity_att = attackers.copy()
+        quantity_def = defenders.copy()
+        count = len(attackers)
+
+        def column(value, default):
+            value = numpy.broadcast_to(numpy.asarray(value, dtype=object), (count,))
+            return numpy.asarray([x if x else default for x in value], dtype=float)
+
+        wall = column(wall, 0)
+        moral = column(moral, 100) / 100
+        luck = 1 + column(luck, 0) / 100
+        nightbonus = numpy.where(column(nightbonus, 0) != 0, 2, 1)
+
+        ram = units.index("ram")
+        resulting_wall = numpy.maximum(
+            0, wall - numpy.round(attackers[:, ram] / (4 * numpy.power(1.09, wall)))
+        )
+        wall_bonus = 1 + resulting_wall * 0.05
+        wall_defense = numpy.where(
+            resulting_wall != 0, numpy.round(numpy.power(1.25, resulting_wall) * 20), 0
+        )
+        defense_keys = ["def_inf", "def_kav", "def_arc"]
+        types = range(len(self.attack_units))
+
+        def type_sums(values, weights):
+            # per attack type, added up in pool order like attack_sum
+            output = numpy.zeros((len(values), len(types)))
+            for i in range(len(units)):
+                output[:, stats["type"][i]] += weights[i] * values[:, i]
+            return output
+
+        def pool_sum(values, weights):
+            output = numpy.zeros(len(values))
+            for i in range(len(units)):
+                output += weights[i] * values[:, i]
+            return output
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            while True:
+                active = (numpy.round(attackers).sum(axis=1) >= 1) & (
+                    numpy.round(defenders).sum(axis=1) >= 1
+                )
+                if not active.any():
+                    break
+                att = attackers[active]
+                dfn = defenders[active]
+                attack_strength = type_sums(att, stats["attack"])
+                food = type_sums(att, stats["food"])
+                food_sum = numpy.round(food).sum(axis=1)
+                copy = dfn.copy()
+                for t in types:
+                    ratio = food[:, t] / food_sum
+                    defense = (
+                        pool_sum(copy, stats[defense_keys[t]])
+                        * ratio
+                        * wall_bonus[active]
+                        * nightbonus[active]
+                        + wall_defense[active] * ratio
+                    )
+                    a = attack_strength[:, t] * moral[active] * luck[active] / defense
+                    fights = (attack_strength[:, t] != 0)[:, None]
+                    lost = (a < 1)[:, None]
+                    # same operation order as simulate, so both round the same way
+                    c = numpy.where(
+                        lost, (numpy.sqrt(a) * a)[:, None], (numpy.sqrt(1 / a) / a)[:, None]
+                    )
+                    ratio = ratio[:, None]
+                    dfn = numpy.where(
+                        fights,
+                        numpy.where(lost, dfn - copy * c * ratio, dfn - ratio * copy),
+                        dfn,
+                    )
+                    survivors = numpy.where(lost, 0, att - c * att)
+                    att = numpy.where(
+                        fights & (stats["type"] == t)[None, :], survivors, att
+                    )
+                attackers[active] = att
+                defenders[active] = dfn
+
+        wall_after = self.post_wall_arrays(
+            quantity_att, attackers, quantity_def, defenders, wall, ram
+        )
+        return attackers, defenders, resulting_wall, wall_after
+
+    def post_wall_arrays(
+        self, quantity_att, attackers, quantity_def, defenders, wall, ram
+    ):
+        rams = quantity_att[:, ram]
+        losses_att = quantity_att - numpy.round(attackers)
+        losses_def = quantity_def - numpy.round(defenders)
+        def_sum = numpy.round(quantity_def).sum(axis=1)
+        lose_def = numpy.where(
+            def_sum != 0,
+            numpy.round(losses_def).sum(axis=1) / numpy.where(def_sum != 0, def_sum, 1),
+            1,
+        )
+        att_sum = numpy.round(quantity_att).sum(axis=1)
+        lose_att = numpy.round(losses_att).sum(axis=1) / numpy.where(
+            att_sum != 0, att_sum, 1
+        )
+        ram_attack = self.pool["ram"]["attack"]
+        dmg = (rams * ram_attack) / (4 * numpy.power(1.09, wall))
+        resulting = numpy.where(
+            lose_def == 1,
+            wall - numpy.round(dmg - 0.5 * dmg * lose_att),
+            wall
+            - numpy.round(
+                rams * ram_attack * lose_def / (8 * numpy.power(1.09, wall))
+            ),
+        )
+        resulting = numpy.maximum(0, resulting)
+        return numpy.where((rams == 0) | (wall == 0), wall, resulting)
+
+    def simulate_many(
+        self, attackers, defenders, wall=0, nightbonus=False, moral=100, luck=0
+    ):
+        """
+        simulate for a list of attacker and defender unit dicts, same results as calling simulate for each pair
+        wall, nightbonus, moral and luck are a single value or a list with one value per scenario
+        """
+        count = len(attackers)
+
+        def per_scenario(value):
+            return list(value) if type(value) in (list, tuple) else [value] * count
+
+        settings = [
+            per_scenario(wall),
+            per_scenario(nightbonus),
+            per_scenario(moral),
+            per_scenario(luck),
+        ]
+        if not has_numpy:
+            return [
+                self.simulate(attackers[i], defenders[i], *scenario)
+                for i, scenario in enumerate(zip(*settings))
+            ]
+        units = list(self.pool)
+        att = [[x.get(unit, 0) for unit in units] for x in attackers]
+        dfn = [[x.get(unit, 0) for unit in units] for x in defenders]
+        left_att, left_def, wall_during, wall_after = self.simulate_arrays(
+            att, dfn, *settings
+        )
+        losses_att = numpy.asarray(att) - numpy.round(left_att).astype(numpy.int64)
+        losses_def = numpy.asarray(dfn) - numpy.round(left_def).astype(numpy.int64)
+        losses_att = losses_att.tolist()
+        losses_def = losses_def.tolist()
+        walls = settings[0]
+        output = []
+        for i in range(count):
+            output.append(
+                {
+                    "attacker": {
+                        "quantity": dict(zip(units, att[i])),
+                        "losses": dict(zip(units, losses_att[i])),
+                    },
+                    "defender": {
+                        "quantity": dict(zip(units, dfn[i])),
+                        "losses": dict(zip(units, losses_def[i])),
+                    },
+                    "wall_before": walls[i] if walls[i] else 0,
+                    "wall_during": int(wall_during[i]),
+                    "wall_after": int(wall_after[i]),
+                }
+            )
+        return output
+
+    def unit_cost(self, unit, cost="food"):
+        if cost == "resources":
+            return sum(self.pool[unit][x] for x in ["wood", "clay", "iron"])
+        return self.pool[unit]["food"]
+
+    def minimal_army(
+        self,
+        available,
+        defenders,
+        wall=0,
+        moral=100,
+        luck=-25,
+        max_losses=0.1,
+        cost="food",
+        steps=10,
+        exclude=("snob", "knight"),
+    ):
+        """
+        Cheapest part of the available troops that kills every defender while losing at most max_losses of its value
+        Every candidate mix (single unit types, attack type mixes, everything, with or without rams) is bisected
+        on the fraction of the available troops, all candidates are simulated in one batch per step
+        Luck defaults to the worst case, cost is "food" (population) or "resources"
+        Returns None when nothing clears the village
+        """
+        units = {
+            unit: int(amount)
+            for unit, amount in available.items()
+            if unit in self.pool and unit not in exclude and int(amount) > 0
+        }
+        rams = units.pop("ram", 0)
+        if not units:
+            return None
+        mixes = [{unit: amount} for unit, amount in units.items()]
+        for attack_type in self.attack_units:
+            mix = {
+                unit: units[unit]
+                for unit in self.attack_units[attack_type]
+                if unit in units
+            }
+            if len(mix) > 1:
+                mixes.append(mix)
+        if len(units) > 1:
+            mixes.append(dict(units))
+        if wall and rams:
+            mixes.extend([dict(mix, ram=rams) for mix in mixes])
+        mixes = [dict(x) for x in dict.fromkeys(tuple(sorted(mix.items())) for mix in mixes)]
+
+        def army(mix, fraction):
+            return {unit: int(math.ceil(amount * fraction)) for unit, amount in mix.items()}
+
+        def clears(armies):
+            results = self.simulate_many(
+                armies, [defenders] * len(armies), wall, False, moral, luck
+            )
+            output = []
+            for sent, result in zip(armies, results):
+                killed = all(
+                    result["defender"]["losses"][unit]
+                    == result["defender"]["quantity"][unit]
+                    for unit in self.pool
+                )
+                value = sum(self.unit_cost(unit, cost) * sent[unit] for unit in sent)
+                lost = sum(
+                    self.unit_cost(unit, cost) * result["attacker"]["losses"][unit]
+                    for unit in sent
+                )
+                output.append(killed and lost <= max_losses * value)
+            return output
+
+        # only mixes that clear the village with every available unit are worth a search
+        mixes = [mix for mix, ok in zip(mixes, clears(mixes)) if ok]
+        if not mixes:
+            return None
+        low = [0.0] * len(mixes)
+        high = [1.0] * len(mixes)
+        for _ in range(steps):
+            middle = [(low[i] + high[i]) / 2 for i in range(len(mixes))]
+            ok = clears([army(mix, middle[i]) for i, mix in enumerate(mixes)])
+            for i in range(len(mixes)):
+                if ok[i]:
+                    high[i] = middle[i]
+                else:
+                    low[i] = middle[i]
+
+        armies = [army(mix, high[i]) for i, mix in enumerate(mixes)]
+        return min(
+            armies,
+            key=lambda x: (
+                sum(self.unit_cost(unit, cost) * x[unit] for unit in x),
+                sum(x.values()),
+            ),
+        )
+
 
 class SimCache:
     @staticmethod
@@ -435,3 +714,52 @@ class SimCache:
 
         for unit in entry["response"]["unit_data"]:
             return
+
+
+def golden_scenarios(count=500, seed=1):
+    """
+    Fixed random battles, from farm runs against a few spears to full nukes with rams against walls
+    """
+    rng = random.Random(seed)
+    units = list(Simulator.pool)
+    output = []
+    for _ in range(count):
+        attacker = {
+            unit: rng.choice([0, 0, rng.randint(1, 20), rng.randint(1, 3000)])
+            for unit in units
+        }
+        defender = {
+            unit: rng.choice([0, 0, rng.randint(1, 20), rng.randint(1, 3000)])
+            for unit in units
+        }
+        output.append(
+            (
+                attacker,
+                defender,
+                rng.choice([0, rng.randint(1, 20)]),
+                rng.random() < 0.2,
+                rng.choice([100, rng.randint(30, 100)]),
+                rng.choice([0, rng.randint(-25, 25)]),
+            )
+        )
+    return output
+
+
+if __name__ == "__main__":
+    # golden check: the batched simulator has to match simulate for every scenario
+    scenarios = golden_scenarios(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
+    sim = Simulator()
+    expected = [sim.simulate(*scenario) for scenario in scenarios]
+    result = sim.simulate_many(
+        [x[0] for x in scenarios],
+        [x[1] for x in scenarios],
+        wall=[x[2] for x in scenarios],
+        nightbonus=[x[3] for x in scenarios],
+        moral=[x[4] for x in scenarios],
+        luck=[x[5] for x in scenarios],
+    )
+    mismatches = [i for i in range(len(scenarios)) if expected[i] != result[i]]
+    print("%d scenarios, %d mismatches" % (len(scenarios), len(mismatches)))
+    for i in mismatches[:10]:
+        print(scenarios[i])
+    sys.exit(1 if mismatches else 0)
@@ -64,6 +64,21 @@ class TroopManager:
         "knight": 10,
         "snob": 35,
     }
+    # resources a single unit carries back from a farm
+    unit_carry = {
+        "spear": 25,
+        "sword": 15,
+        "axe": 10,
+        "archer": 10,
+        "spy": 0,
+        "light": 80,
+        "marcher": 50,
+        "heavy": 50,
+        "ram": 0,
+        "catapult": 0,
+        "knight": 100,
+        "snob": 0,
+    }
 
     wanted_levels = {}
 
@@ -72,6 +87,12 @@ class TroopManager:
     resman = None
     template = None
 
+    # totals from the bulk village overview, saves a rally point request per village
+    # only used once, recruiting changes the totals
+    seeded_totals = None
+    seeded_at = 0
+    seed_ttl = 600
+
     def __init__(self, wrapper=None, village_id=None):
         self.wrapper = wrapper
         self.village_id = village_id
@@ -85,6 +106,21 @@ class TroopManager:
         # unit speed / world speed == speed per cell
         return self.unit_speeds[unit] / world_speed
 
+    def template_speed(self, template):
+        # minutes per field of the slowest unit in the template
+        speeds = [
+            self.unit_speeds[unit]
+            for unit in template
+            if unit in self.unit_speeds and int(template[unit]) > 0
+        ]
+        return max(speeds) if speeds else 0
+
+    def seed_totals(self, totals, ttl=None, at=None):
+        self.seeded_totals = dict(totals)
+        self.seeded_at = at or time.time()
+        if ttl:
+            self.seed_ttl = ttl
+
     def update_totals(self, first_run=False):
         # if self.total_troops != {} and not first_run:
         #     # No need to update if we already have the total!
@@ -113,6 +149,14 @@ class TroopManager:
         if not self.can_recruit:
             return
 
+        if self.seeded_totals and self.seeded_at + self.seed_ttl > time.time():
+            self.total_troops = dict(self.seeded_totals)
+            self.seeded_totals = None
+            self.logger.debug(
+                "Village units total (overview): %s" % str(self.total_troops)
+            )
+            return
+
         get_all = (
             "game.php?village=%s&screen=place&mode=units&display=units"
             % self.village_id
@@ -407,23 +451,23 @@ class TroopManager:
 
                 troops = dict(self.troops)
                 can_use = [
-                    "spear:25",
-                    "sword:15",
-                    # "axe:10",
-                    "archer:10",
-                    # "light:80",
-                    "marcher:50",
-                    "heavy:50",
-                    "knight:100",
+                    "spear",
+                    "sword",
+                    # "axe",
+                    "archer",
+                    # "light",
+                    "marcher",
+                    "heavy",
+                    "knight",
                 ]
                 # if selection > 1:
                 #     can_use = [
-                #         "axe:10",
-                #         "light:80",
-                #         "archer:10",
-                #         "marcher:50",
-                #         "heavy:50",
-                #         "knight:100",
+                #         "axe",
+                #         "light",
+                #         "archer",
+                #         "marcher",
+                #         "heavy",
+                #         "knight",
                 #     ]
                 payload = {
                     "squad_requests[0][village_id]": self.village_id,
@@ -435,7 +479,7 @@ class TroopManager:
                 used_troops = []
                 max_use = 100
                 for item in can_use:
-                    item, carry = item.split(":")
+                    carry = self.unit_carry[item]
                     if item == "knight":
                         continue
                     if item in disabled_units:
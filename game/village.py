@@ -38,6 +38,14 @@ class Village:
     config = None
     village_set_name = None
     next_event = {"kind": None, "time": None}
+    # earliest upcoming timestamp per event kind, used by the event scheduler
+    upcoming_events = {}
+    # data from the bulk village overview (resources, storage, population, troops)
+    overview = None
+    overview_at = 0
+    # the overview data is only used by the first run after the sweep that loaded it, if it is this young
+    overview_fresh = 600
+    overview_used = False
 
     twp = TwPlus()
 
@@ -55,6 +63,9 @@ class Village:
             # Ignore old timers
             return
 
+        if kind not in self.upcoming_events or self.upcoming_events[kind] > time:
+            self.upcoming_events[kind] = time
+
         if not self.next_event["time"]:
             self.next_event["time"] = time
             self.next_event["kind"] = kind
@@ -138,6 +149,36 @@ class Village:
                     self.units.wait_for[self.village_id][building],
                 )
 
+    def seed_overview(self, entry):
+        self.overview = entry
+        self.overview_at = time.time()
+        self.overview_used = False
+        if self.units and "total" in entry:
+            self.units.seed_totals(entry["total"], ttl=self.overview_fresh)
+
+    def use_overview(self):
+        """
+        Takes resources, storage, population and the troops at home from a fresh bulk overview
+        so the village overview page does not have to be loaded, not when attacks are incoming
+        """
+        entry = self.overview
+        if (
+            not entry
+            or self.overview_used
+            or not self.game_data
+            or self.overview_at + self.overview_fresh < time.time()
+            or entry.get("incoming")
+        ):
+            return False
+        keys = ["wood", "stone", "iron", "storage_max", "pop", "pop_max"]
+        if not all(key in entry for key in keys) or "home" not in entry:
+            return False
+        village = dict(self.game_data["village"])
+        village.update({key: entry[key] for key in keys})
+        self.game_data = dict(self.game_data, village=village)
+        self.overview_used = True
+        return True
+
     def get_config(self, section, parameter, default=None):
         if section not in self.config:
             self.logger.warning("Configuration section %s does not exist!" % section)
@@ -233,6 +274,10 @@ class Village:
         if not self.units:
             self.units = TroopManager(wrapper=self.wrapper, village_id=self.village_id)
             self.units.resman = self.resman
+            if self.overview and "total" in self.overview:
+                self.units.seed_totals(
+                    self.overview["total"], ttl=self.overview_fresh, at=self.overview_at
+                )
         self.units.max_batch_size = self.get_config(
             section="units", parameter="batch_size", default=25
         )
@@ -422,6 +467,9 @@ class Village:
 
             if not self.area:
                 self.area = Map(wrapper=self.wrapper, village_id=self.village_id)
+            self.area.radius = self.get_config(
+                section="farms", parameter="search_radius", default=50
+            )
             self.area.get_map()
             if self.area.villages:
                 self.units.can_scout = self.get_config(
@@ -446,6 +494,23 @@ class Village:
                     self.logger.info("Forced peace time coming up today!")
                     self.attack.forced_peace_time = forced_peace_today_start
 
+                # the same radius the map sectors were loaded for
+                self.attack.farm_radius = self.area.radius
+                self.attack.loot_assistant = self.get_config(
+                    section="farms", parameter="loot_assistant", default=False
+                )
+                self.attack.carry_sizing = self.get_config(
+                    section="farms", parameter="carry_sizing", default=False
+                )
+                self.attack.clear_defended = self.get_config(
+                    section="farms", parameter="clear_defended", default=False
+                )
+                self.attack.clear_max_losses = self.get_config(
+                    section="farms", parameter="clear_max_losses", default=0.1
+                )
+                self.attack.world_speed = self.get_config(
+                    section="world", parameter="world_unit_speed", default=1
+                )
                 self.attack.target_high_points = self.get_config(
                     section="farms", parameter="attack_higher_points", default=False
                 )
@@ -568,12 +633,16 @@ class Village:
                     self.village_id, "TWB_QUEST", "Collected quest reward(s)"
                 )
 
-    def run(self, config=None, first_run=False):
+    def run(self, config=None, first_run=False, managers=None):
+        # managers: only run these managers (event driven run), None runs everything
         # setup and check if village still exists / is accessible
         self.config = config
         self.wrapper.delay = self.get_config(
             section="bot", parameter="delay_factor", default=1.0
         )
+        # cached pages only help within a run, every run starts from fresh pages
+        if self.village_id:
+            self.wrapper.clear_page_cache(self.village_id)
         if not self.village_id:
             data = self.wrapper.get_url("game.php?screen=overview&intro")
             if data:
@@ -584,6 +653,14 @@ class Village:
                     "Village %s" % self.game_data["village"]["name"]
                 )
                 self.logger.info("Read game state for village")
+        elif self.use_overview():
+            data = None
+            self.logger.info("Read game state for village from the overview")
+            self.wrapper.reporter.report(
+                self.village_id,
+                "TWB_START",
+                "Starting run for village: %s" % self.game_data["village"]["name"],
+            )
         else:
             data = self.wrapper.get_url(
                 "game.php?village=%s&screen=overview" % self.village_id
@@ -636,11 +713,13 @@ class Village:
             self.village_id, "TWB_PRE_RESOURCE", str(self.resman.actual)
         )
 
+        # the bot normally hands every village the shared report manager and reads reports once per cycle
         if not self.rep_man:
             self.rep_man = ReportManager(
                 wrapper=self.wrapper, village_id=self.village_id
             )
-        self.rep_man.read(full_run=False)
+            if not managers or "attacks" in managers:
+                self.rep_man.read(full_run=False)
 
         if not self.def_man:
             self.def_man = DefenceManager(
@@ -669,7 +748,8 @@ class Village:
             self.village_id, parameter="evacuate_fragile_units_on_attack", default=False
         )
         self.def_man.update(
-            data.text,
+            # a fresh overview without incoming attacks stands in for the page
+            data.text if data else "",
             with_defence=self.get_config(
                 section="units", parameter="manage_defence", default=False
             ),
@@ -687,22 +767,27 @@ class Village:
         # Load troops in village...
         if not self.units:
             self.setup_units()
-        for u in Extractor.units_in_village(data):
-            k, v = u
-            self.units.troops[k] = v
+        if data:
+            for u in Extractor.units_in_village(data):
+                k, v = u
+                self.units.troops[k] = v
+        else:
+            for k, v in self.overview["home"].items():
+                self.units.troops[k] = str(v)
 
         # Act more human like and do things in an random(ish) order - Market is always last?
-        functions = [
-            self.run_quests,
-            self.run_builder,
-            self.run_research,
-            self.run_snob,
-            self.run_recruit,
-            self.run_attacks,
-        ]
-        random.shuffle(functions)
-        for func in functions:
-            func()
+        functions = {
+            "quests": self.run_quests,
+            "builder": self.run_builder,
+            "research": self.run_research,
+            "snob": self.run_snob,
+            "recruit": self.run_recruit,
+            "attacks": self.run_attacks,
+        }
+        run_order = [x for x in functions if not managers or x in managers]
+        random.shuffle(run_order)
+        for name in run_order:
+            functions[name]()
         # self.run_quests()
 
         # self.run_builder()
@@ -729,7 +814,8 @@ class Village:
         # self.run_attacks()
 
         # market management
-        self.run_market()
+        if not managers or "market" in managers:
+            self.run_market()
 
         res = self.wrapper.get_action(village_id=self.village_id, action="overview")
         self.game_data = Extractor.game_state(res)
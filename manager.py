@@ -1,48 +1,67 @@
 import json
-import os
-from game.reports import ReportCache
+import threading
+import time
+import traceback
+from game.reports import FarmStats, ReportCache
 from game.attack import AttackCache
 
 
 class VillageManager:
+    # latest bot config, handed over by the bot every cycle
+    config = None
+    interval = 3600
+    worker = None
+    stop = threading.Event()
+
+    @staticmethod
+    def start_worker(config, interval=3600, verbose=False):
+        """
+        Runs the farm manager every interval seconds on a background thread
+        """
+        VillageManager.config = config
+        VillageManager.interval = interval
+        if VillageManager.worker and VillageManager.worker.is_alive():
+            return
+        VillageManager.stop.clear()
+        VillageManager.worker = threading.Thread(
+            target=VillageManager.run_worker, args=(verbose,), daemon=True
+        )
+        VillageManager.worker.start()
+
+    @staticmethod
+    def run_worker(verbose=False):
+        while not VillageManager.stop.is_set():
+            start = time.time()
+            try:
+                VillageManager.farm_manager(verbose=verbose, config=VillageManager.config)
+            except Exception as e:
+                print("[Farm Manager] Failed: %s" % str(e))
+                traceback.print_exc()
+            VillageManager.stop.wait(max(60, VillageManager.interval - (time.time() - start)))
+
     @staticmethod
-    def farm_manager(verbose=False):
-        with open("config.json", "r") as f:
-            config = json.load(f)
+    def farm_manager(verbose=False, config=None):
+        if not config:
+            with open("config.json", "r") as f:
+                config = json.load(f)
 
         if verbose:
             print("[Farm Manager] Villages: %d" % len(config["villages"]))
         attacks = AttackCache.cache_grab()
-        reports = ReportCache.cache_grab()
+        stats = FarmStats.get_all()
 
         if verbose:
-            print("[Farm Manager] Reports: %d" % len(reports))
             print("[Farm Manager] Farms: %d" % len(attacks))
         t = {"wood": 0, "iron": 0, "stone": 0}
         for farm in attacks:
             data = attacks[farm]
-
-            num_attack = []
-            loot = {"wood": 0, "iron": 0, "stone": 0}
-            total_loss_count = 0
-            total_sent_count = 0
-            for rep in reports:
-                if reports[rep]["dest"] == farm and reports[rep]["type"] == "attack":
-                    for unit in reports[rep]["extra"]["units_sent"]:
-                        total_sent_count += reports[rep]["extra"]["units_sent"][unit]
-                    for unit in reports[rep]["losses"]:
-                        total_loss_count += reports[rep]["losses"][unit]
-                    try:
-                        res = reports[rep]["extra"]["loot"]
-                        for r in res:
-                            loot[r] = loot[r] + int(res[r])
-                            t[r] = t[r] + int(res[r])
-                        num_attack.append(reports[rep])
-                    except:
-                        pass
-            percentage_lost = 0
-            if total_sent_count > 0:
-                percentage_lost = total_loss_count / total_sent_count * 100
+            if farm not in stats:
+                continue
+            farm_stats = stats[farm]
+            for r in t:
+                t[r] += farm_stats["loot"][r]
+            num_attack = farm_stats["attacks"]
+            percentage_lost = farm_stats["percentage_lost"]
 
             perf = "Normal ".rjust(15)
             if data["high_profile"]:
@@ -51,97 +70,74 @@ class VillageManager:
                 perf = "Low Profile ".rjust(15)
             if verbose:
                 print(
-                    "%sFarm village %s attacked %d times - Total loot: %s - Total units lost: %s (%s)"
+                    "%sFarm village %s attacked %d times - Total loot: %s - Total units lost: %s (%s) - Last haul: %d"
                     % (
                         perf,
                         farm,
-                        len(num_attack),
-                        str(loot),
-                        str(total_loss_count),
+                        num_attack,
+                        str(farm_stats["loot"]),
+                        str(farm_stats["units_lost"]),
                         str(percentage_lost),
+                        farm_stats["last_haul"],
                     )
                 )
-            if len(num_attack):
-                total = 0
-                for k in loot:
-                    total += loot[k]
-                if len(num_attack) > 3:
-                    if total / len(num_attack) < 100 and (
-                        "low_profile" not in data or not data["low_profile"]
-                    ):
-                        if verbose:
-                            print(
-                                "Farm %s has very low resources (%d avg total), extending farm time"
-                                % (farm, total / len(num_attack))
-                            )
-                        data["low_profile"] = True
-                        AttackCache.set_cache(farm, data)
-                    elif total / len(num_attack) >= 100 and (
-                        "low_profile" in data and data["low_profile"]
-                    ):
-                        if verbose:
-                            print(
-                                "Farm %s had very low resources, now back up to normal? (%d avg total), resetting farm time"
-                                % (farm, total / len(num_attack))
-                            )
-                        data["low_profile"] = False
-                        AttackCache.set_cache(farm, data)
-                    elif total / len(num_attack) > 500 and (
-                        "high_profile" not in data or not data["high_profile"]
-                    ):
-                        if verbose:
-                            print(
-                                "Farm %s has very high resources (%d avg total), setting to high profile"
-                                % (farm, total / len(num_attack))
-                            )
-                        data["high_profile"] = True
-                        AttackCache.set_cache(farm, data)
+            changed = {}
+            average = farm_stats["average_haul"]
+            if num_attack > 3:
+                if average < 100 and (
+                    "low_profile" not in data or not data["low_profile"]
+                ):
+                    if verbose:
+                        print(
+                            "Farm %s has very low resources (%d avg total), extending farm time"
+                            % (farm, average)
+                        )
+                    changed["low_profile"] = data["low_profile"] = True
+                elif average >= 100 and (
+                    "low_profile" in data and data["low_profile"]
+                ):
+                    if verbose:
+                        print(
+                            "Farm %s had very low resources, now back up to normal? (%d avg total), resetting farm time"
+                            % (farm, average)
+                        )
+                    changed["low_profile"] = data["low_profile"] = False
+                elif average > 500 and (
+                    "high_profile" not in data or not data["high_profile"]
+                ):
+                    if verbose:
+                        print(
+                            "Farm %s has very high resources (%d avg total), setting to high profile"
+                            % (farm, average)
+                        )
+                    changed["high_profile"] = data["high_profile"] = True
 
-            if percentage_lost > 20 and not data["low_profile"]:
+            if percentage_lost > 20 and not data.get("low_profile"):
                 print(
                     f"[Farm Manager] Dangerous {percentage_lost} percentage lost units! Extending farm time"
                 )
-                data["low_profile"] = True
-                data["high_profile"] = False
-                AttackCache.set_cache(farm, data)
-            # if percentage_lost > 50 and len(num_attack) > 10:
+                changed["low_profile"] = data["low_profile"] = True
+                changed["high_profile"] = data["high_profile"] = False
+            # if percentage_lost > 50 and num_attack > 10:
             #     print("[Farm Manager] Farm seems too dangerous/ unprofitable to farm. Setting safe to false!")
-            #     data["safe"] = False
-            #     AttackCache.set_cache(farm, data)
+            #     changed["safe"] = data["safe"] = False
 
-        for report in reports:
-            r = reports[report]
-            total_loss_count = 0
-            if r["type"] == "scout" or r["type"] == "attack":
-                if r["losses"] != {}:
-                    for unit in r["losses"]:
-                        total_loss_count += (
-                            r["losses"][unit] * 2
-                            if unit == "light"
-                            else r["losses"][unit]
-                        )
-                    if total_loss_count > 10 and verbose:
-                        print(
-                            f"[Farm Manager] Dangerous: {r} -> {total_loss_count} total loss count, extending farm time"
-                        )
-                    if total_loss_count > 10:
-                        data["low_profile"] = True
-                        AttackCache.set_cache(farm, data)
+            if farm_stats["last_loss"] > 10 and not data.get("low_profile"):
+                if verbose:
+                    print(
+                        f"[Farm Manager] Dangerous: last report for {farm} -> {farm_stats['last_loss']} total loss count, extending farm time"
+                    )
+                changed["low_profile"] = data["low_profile"] = True
+            if changed:
+                AttackCache.update(farm, changed)
 
         if verbose:
             print("[Farm Manager] Total loot: %s" % t)
 
-        list_of_files = sorted(
-            ["./cache/reports/" + f for f in os.listdir("./cache/reports/")],
-            key=os.path.getctime,
-        )
-
-        print(f"Found {len(list_of_files)} files")
-
-        while len(list_of_files) > 350:
-            oldest_file = list_of_files.pop(0)
-            print(f"[Farm Manager] Delete old report ({oldest_file})")
-            os.remove(os.path.abspath(oldest_file))
+        retention = config["bot"].get("report_retention", 100000)
+        removed = ReportCache.prune(retention)
+        if removed:
+            print(f"[Farm Manager] Removed {removed} old reports (keeping {retention})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+from core.extractors import Extractor
+
+PRODUCTION = """
+<table id="production_table" class="vis overview_table">
+<tr><th>Village</th><th>Resources</th><th>Warehouse</th><th>Farm</th></tr>
+<tr class="nowrap row_a">
+<td><span class="quickedit-vn" data-id="1001"><a href="#">Village 001</a></span></td>
+<td><span class="res wood">12<span class="grey">.</span>345</span>
+<span class="res stone"><span class="warn_90">98<span class="grey">.</span>000</span></span>
+<span class="res iron"><span class="warn">100<span class="grey">.</span>000</span></span></td>
+<td>100000</td>
+<td>2500/24000</td>
+</tr>
+<tr class="nowrap row_b">
+<td><span class="quickedit-vn" data-id="1002"><a href="#">Village 002</a></span>
+<img src="https://dsnl.innogamescdn.com/graphic/command/attack.png"></td>
+<td><span class="res wood">500</span> <span class="res stone">?</span>
+<span class="res iron">700</span></td>
+<td>8000</td>
+<td>100/300</td>
+</tr>
+</table>
+"""
+
+GAME_STATE = """
+<script>TribalWars.updateGameData({"village": {"id": 1001, "buildings": {"main": "3"}}});</script>
+"""
+
+UNITS = """
+<table id="units_table" class="vis overview_table">
+<thead><tr><th>Village</th><th></th>
+<th><img src="https://dsnl.innogamescdn.com/graphic/unit/unit_spear.png"></th>
+<th><img src="https://dsnl.innogamescdn.com/graphic/unit/unit_axe.webp"></th>
+</tr></thead>
+<tbody class="row_a">
+<tr><td><span class="quickedit-vn" data-id="1001">Village 001</span></td><td>own</td>
+<td class="unit-item">10</td><td class="unit-item hidden">0</td></tr>
+<tr><td>in villages</td><td class="unit-item">5</td><td class="unit-item">0</td></tr>
+<tr><td>total</td><td class="unit-item">15</td><td class="unit-item">20</td></tr>
+</tbody>
+</table>
+"""
+
+
+def test_overview_production():
+    production = Extractor.overview_production(PRODUCTION)
+    assert production["1001"] == {
+        "incoming": 0,
+        "wood": 12345,
+        "stone": 98000,
+        "iron": 100000,
+        "storage_max": 100000,
+        "pop": 2500,
+        "pop_max": 24000,
+    }
+    # unreadable amounts are left out instead of becoming 0
+    assert "stone" not in production["1002"]
+    assert production["1002"]["wood"] == 500
+    assert production["1002"]["incoming"] == 1
+
+
+def test_overview_units():
+    units = Extractor.overview_units(UNITS)
+    assert units == {
+        "1001": {"home": {"spear": 10, "axe": 0}, "total": {"spear": 15, "axe": 20}}
+    }
+
+
+def test_game_state_is_a_copy():
+    # a response keeps its parsed page, readers must not change each others data
+    res = SimpleNamespace(text=GAME_STATE)
+    state = Extractor.game_state(res)
+    state["village"]["buildings"]["main"] = "4"
+    assert Extractor.game_state(res)["village"]["buildings"]["main"] == "3"
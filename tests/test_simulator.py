@@ -0,0 +1,34 @@
+import pytest
+
+from game import simulator
+from game.simulator import Simulator, golden_scenarios
+
+
+def test_simulate_keeps_input():
+    attacker = {"axe": 100, "light": 20}
+    defender = {"spear": 50}
+    Simulator().simulate(attacker, defender, 0, False, 100, 0)
+    assert attacker == {"axe": 100, "light": 20}
+    assert defender == {"spear": 50}
+
+
+def test_simulate_attacker_loses():
+    result = Simulator().simulate({"axe": 10}, {"spear": 500}, 5, False, 100, 0)
+    assert result["attacker"]["losses"]["axe"] == 10
+
+
+def test_batched_matches_simulate():
+    pytest.importorskip("numpy")
+    assert simulator.has_numpy
+    scenarios = golden_scenarios(500, seed=1)
+    sim = Simulator()
+    expected = [sim.simulate(*scenario) for scenario in scenarios]
+    result = sim.simulate_many(
+        [x[0] for x in scenarios],
+        [x[1] for x in scenarios],
+        wall=[x[2] for x in scenarios],
+        nightbonus=[x[3] for x in scenarios],
+        moral=[x[4] for x in scenarios],
+        luck=[x[5] for x in scenarios],
+    )
+    assert result == expected
@@ -13,6 +13,10 @@ import requests
 
 from core.extractors import Extractor
 from core.request import WebWrapper
+from core.scheduler import EventScheduler
+from game.attack import AttackCache
+from game.planner import FarmPlanner
+from game.reports import ReportManager
 from game.village import Village
 from manager import VillageManager
 
@@ -35,6 +39,8 @@ class TWB:
     should_run = True
     runs = 0
     world_unit_speed = 1
+    scheduler = None
+    result_villages = None
 
     def internet_online(self):
         try:
@@ -150,7 +156,9 @@ class TWB:
         return new_config
 
     def get_overview(self, config):
-        result_get = self.wrapper.get_url("game.php?screen=overview_villages")
+        result_get = self.wrapper.get_url(
+            "game.php?screen=overview_villages&mode=prod&page=-1"
+        )
         result_villages = None
         has_new_villages = False
         if config["bot"].get("add_new_villages", False):
@@ -168,6 +176,26 @@ class TWB:
 
         return result_villages, result_get
 
+    def refresh_overviews(self, overview_page):
+        # production and unit overviews (premium account) hold the data of every village at once
+        production = Extractor.overview_production(overview_page)
+        if not production:
+            return False
+        units = Extractor.overview_units(
+            self.wrapper.get_url(
+                "game.php?screen=overview_villages&mode=units&type=complete&page=-1"
+            )
+        )
+        for vil in self.villages:
+            if vil.village_id not in production:
+                continue
+            entry = dict(production[vil.village_id])
+            if vil.village_id in units:
+                entry.update(units[vil.village_id])
+            vil.seed_overview(entry)
+        print("Refreshed overview data for %d villages" % len(production))
+        return True
+
     def add_village(self, vid, template=None):
         original = self.config()
         with open("config.bak", "w") as backup:
@@ -261,7 +289,12 @@ class TWB:
             discord_notifier=config["discord_notify"]["enabled"],
             discord_notifier_endpoint=config["discord_notify"]["endpoint"],
             proxy_enabled=config["proxy"]["enabled"],
-            proxy_endpoint=config["proxy"]["endpoint"],            
+            proxy_endpoint=config["proxy"]["endpoint"],
+            page_cache_ttl=config["bot"].get("page_cache_ttl", 0),
+            request_rate=config["bot"].get("request_rate", 12),
+            request_burst=config["bot"].get("request_burst", 5),
+            request_jitter=config["bot"].get("request_jitter", 1.0),
+            max_in_flight=config["bot"].get("max_in_flight", 1),
         )
 
         self.wrapper.start()
@@ -276,8 +309,21 @@ class TWB:
         for vid in config["villages"]:
             v = Village(wrapper=self.wrapper, village_id=vid)
             self.villages.append(copy.deepcopy(v))
+        if config["bot"].get("event_scheduler", False):
+            self.scheduler = EventScheduler(
+                sweep_interval=config["bot"].get("full_sweep_interval", 3600),
+                recheck_interval=config["bot"].get("recheck_interval", 1800),
+            )
         # setup additional builder
         rm = None
+        if self.villages:
+            rm = ReportManager(
+                wrapper=self.wrapper, village_id=self.villages[0].village_id
+            )
+            rm.background = config["bot"].get("report_background_fetch", False)
+            rm.parse_workers = config["bot"].get("report_parse_workers", 1)
+            rm.keep_raw = config["bot"].get("report_keep_raw", False)
+            rm.world_speed = config["world"].get("speed", 1) or 1
         defense_states = {}
         self.wrapper.discord.send("TWB starting...")
         while self.should_run:
@@ -302,27 +348,50 @@ class TWB:
                 time.sleep(sleep)
             else:
                 config = self.config()
-                result_villages, res_text = self.get_overview(config)
-                has_changed, new_cf = self.get_world_options(res_text.text, config)
-                if has_changed:
-                    print("Updated world options")
-                    config = self.merge_configs(config, new_cf)
-                    with open("config.json", "w") as newcf:
-                        json.dump(config, newcf, indent=2, sort_keys=False)
-                        print("Deployed new configuration file")
+                sweep = not self.scheduler or self.scheduler.sweep_due()
+                due = {}
+                if sweep:
+                    result_villages, res_text = self.get_overview(config)
+                    self.result_villages = result_villages
+                    self.refresh_overviews(res_text)
+                    has_changed, new_cf = self.get_world_options(res_text.text, config)
+                    if has_changed:
+                        print("Updated world options")
+                        config = self.merge_configs(config, new_cf)
+                        with open("config.json", "w") as newcf:
+                            json.dump(config, newcf, indent=2, sort_keys=False)
+                            print("Deployed new configuration file")
+                else:
+                    due = self.scheduler.pop_due()
+                    print("Event driven run for %d village(s)" % len(due))
+                FarmPlanner.enabled = config["farms"].get("farm_planner", False)
+                if FarmPlanner.enabled:
+                    # uses the targets and troops the villages registered in the previous cycle
+                    FarmPlanner.plan()
+                if rm and (
+                    sweep
+                    or any(
+                        m is None or "attacks" in m or "market" in m
+                        for m in due.values()
+                    )
+                ):
+                    # one report read per cycle for the whole account
+                    rm.read(full_run=False)
                 vnum = 1
                 seconds_till_next_event = 1000000000000000000000000000000
                 for vil in list(set(self.villages)):
-                    if result_villages and vil.village_id not in result_villages:
+                    if (
+                        self.result_villages
+                        and vil.village_id not in self.result_villages
+                    ):
                         print(
                             "Village %s will be ignored because it is not available anymore"
                             % vil.village_id
                         )
                         continue
-                    if not rm:
-                        rm = vil.rep_man
-                    else:
-                        vil.rep_man = rm
+                    if not sweep and vil.village_id not in due:
+                        continue
+                    vil.rep_man = rm
                     if (
                         "auto_set_village_names" in config["bot"]
                         and config["bot"]["auto_set_village_names"]
@@ -338,7 +407,12 @@ class TWB:
                         vil.village_set_name = template
 
                     vil.next_event = {"kind": None, "time": None}
-                    vil.run(config=config, first_run=vnum == 1)
+                    vil.upcoming_events = {}
+                    vil.run(
+                        config=config,
+                        first_run=vnum == 1,
+                        managers=None if sweep else due[vil.village_id],
+                    )
                     if (
                         vil.get_config(
                             section="units", parameter="manage_defence", default=False
@@ -353,9 +427,13 @@ class TWB:
                     vil.determine_next_building_done()
                     vil.determine_next_recruitment()
                     vil.determine_first_gather_back()
+                    if self.scheduler:
+                        self.scheduler.schedule_village(vil)
                     if seconds_till_next_event > vil.get_seconds_till_next_event():
                         seconds_till_next_event = vil.get_seconds_till_next_event()
                     vnum += 1
+                if sweep and self.scheduler:
+                    self.scheduler.swept()
 
                 if len(defense_states) and config["farms"]["farm"]:
                     for vil in self.villages:
@@ -366,17 +444,23 @@ class TWB:
                 active_h = [int(x) for x in config["bot"]["active_hours"].split("-")]
                 get_h = time.localtime().tm_hour
                 if get_h in range(active_h[0], active_h[1]):
-                    sleep = config["bot"]["active_delay"]
-                    print(
-                        f"Seconds until next event for a village: {round(seconds_till_next_event, 2)}"
-                    )
-                    # if sleep > seconds_till_next_event:
-                    #     print("Sleep would be more than the next event for a village!")
-                    if sleep < seconds_till_next_event:
+                    if self.scheduler:
+                        sleep = self.scheduler.seconds_till_next_wake()
                         print(
-                            "Sleep is less than the next event for a village! Delaying until next event..."
+                            f"Seconds until next scheduled event: {round(sleep, 2)}"
                         )
-                        sleep = seconds_till_next_event
+                    else:
+                        sleep = config["bot"]["active_delay"]
+                        print(
+                            f"Seconds until next event for a village: {round(seconds_till_next_event, 2)}"
+                        )
+                        # if sleep > seconds_till_next_event:
+                        #     print("Sleep would be more than the next event for a village!")
+                        if sleep < seconds_till_next_event:
+                            print(
+                                "Sleep is less than the next event for a village! Delaying until next event..."
+                            )
+                            sleep = seconds_till_next_event
                 else:
                     if config["bot"]["inactive_still_active"]:
                         sleep = config["bot"]["inactive_delay"]
@@ -391,7 +475,14 @@ class TWB:
                 dt_next = dtn + datetime.timedelta(0, sleep)
                 self.runs += 1
 
-                VillageManager.farm_manager(verbose=True)
+                # farm statistics and report pruning run on their own thread
+                VillageManager.start_worker(
+                    config,
+                    interval=config["bot"].get("farm_manager_interval", 3600),
+                    verbose=True,
+                )
+                AttackCache.flush()
+                print("Request budget: %s" % self.wrapper.governor.summary())
                 print(
                     "Dead for %f minutes (next run at: %s)"
                     % (round(sleep / 60, 2), dt_next.time())
@@ -420,13 +511,14 @@ class TWB:
         self.run()
 
 
-for x in range(3):
-    t = TWB()
-    try:
-        t.start()
-    except Exception as e:
-        t.wrapper.reporter.report(0, "TWB_EXCEPTION", str(e))
-        t.wrapper.discord.send("TWB crashed, check logs for more information - %s" % str(e))
-        print("I crashed :(   %s" % str(e))
-        traceback.print_exc()
-        pass
+if __name__ == "__main__":
+    for x in range(3):
+        t = TWB()
+        try:
+            t.start()
+        except Exception as e:
+            t.wrapper.reporter.report(0, "TWB_EXCEPTION", str(e))
+            t.wrapper.discord.send("TWB crashed, check logs for more information - %s" % str(e))
+            print("I crashed :(   %s" % str(e))
+            traceback.print_exc()
+            pass
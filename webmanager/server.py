@@ -128,8 +128,8 @@ def pre_process_village_config(village_id):
 
 
 def sync():
-    reports = DataReader.cache_grab("reports")
-    villages = DataReader.cache_grab("villages")
+    reports = DataReader.reports_grab()
+    villages = DataReader.map_grab()
     attacks = DataReader.cache_grab("attacks")
     config = DataReader.config_grab()
     managed = DataReader.cache_grab("managed")
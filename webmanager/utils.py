@@ -1,5 +1,7 @@
 import os
 import json
+import sqlite3
+import zlib
 import collections
 import subprocess
 import psutil
@@ -27,6 +29,51 @@ class DataReader:
 
         return output
 
+    @staticmethod
+    def map_grab():
+        output = {}
+        c_path = os.path.join("../cache", "map.db")
+        if not os.path.exists(c_path):
+            # bot did not migrate the old layout yet
+            if os.path.exists(os.path.join("../cache", "villages")):
+                return DataReader.cache_grab("villages")
+            return output
+        con = sqlite3.connect(c_path)
+        try:
+            for vid, data in con.execute("SELECT id, data FROM villages"):
+                output[vid] = json.loads(data)
+        except sqlite3.Error as e:
+            print("Map cache read error: %s" % str(e))
+        finally:
+            con.close()
+        return output
+
+    @staticmethod
+    def reports_grab(limit=100):
+        output = {}
+        c_path = os.path.join("../cache", "reports.db")
+        if not os.path.exists(c_path):
+            return output
+        con = sqlite3.connect(c_path)
+        try:
+            for report_id, report_type, origin, dest, losses, extra in con.execute(
+                "SELECT id, type, origin, dest, losses, extra FROM reports "
+                "ORDER BY CAST(id AS INTEGER) DESC LIMIT ?",
+                (limit,),
+            ):
+                output[report_id] = {
+                    "type": report_type,
+                    "origin": origin,
+                    "dest": dest,
+                    "losses": json.loads(losses),
+                    "extra": json.loads(zlib.decompress(extra)),
+                }
+        except sqlite3.Error as e:
+            print("Report cache read error: %s" % str(e))
+        finally:
+            con.close()
+        return output
+
     @staticmethod
     def template_grab(template_location):
         output = []